@@ -13,3 +13,7 @@ class ModelCallback(aiogram.filters.callback_data.CallbackData, prefix="model",
 
 class ProfilePictureCallback(aiogram.filters.callback_data.CallbackData, prefix="profile_pic"):
     action: str
+
+
+class StopStreamCallback(aiogram.filters.callback_data.CallbackData, prefix="stop_stream"):
+    stream_id: int
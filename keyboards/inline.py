@@ -4,6 +4,7 @@ import sqlalchemy.orm as orm
 
 import strings
 import models.user
+import services.model_catalog
 
 from . import callback_data
 
@@ -107,7 +108,7 @@ async def get_settings_keyboard(current_menu_key: str, user: models.user.User,)
 async def get_model_keyboard(user: models.user.User) -> aiogram.types.InlineKeyboardMarkup:
     """Returns button markup for the model selection."""
     builder = aiogram.utils.keyboard.InlineKeyboardBuilder()
-    models = strings.MODELS.copy()
+    models = services.model_catalog.catalog.models.copy()
 
     if user.selected_model is not None and user.selected_model in models:
         models[user.selected_model] = strings.MODEL_SELECTED + models[user.selected_model]
@@ -118,6 +119,12 @@ async def get_model_keyboard(user: models.user.User) -> aiogram.types.InlineKeyb
     builder.adjust(2)
     return builder.as_markup()
 
+async def get_stop_keyboard(stream_id: int) -> aiogram.types.InlineKeyboardMarkup:
+    """Returns button markup for stopping the answer that is being streamed."""
+    builder = aiogram.utils.keyboard.InlineKeyboardBuilder()
+    builder.button(text=strings.STOP_STREAM.BUTTON, callback_data=callback_data.StopStreamCallback(stream_id=stream_id))
+    return builder.as_markup()
+
 async def get_profile_picture_keyboard():
     """Returns button markup for the profile picture loading interaction."""
     builder = aiogram.utils.keyboard.InlineKeyboardBuilder()
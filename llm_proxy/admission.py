@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import math
+import time
+
+import budgets
+import config
+import routing
+from load_data import res_model_list
+
+
+class AdmissionError(Exception):
+    """Request was not admitted, `status` is 429 (queue is full) or 503 (no free slot in time)"""
+
+    def __init__(self, status: int, message: str, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+def provider_of(deployment: dict) -> str:
+    """Provider prefix of the litellm model name, e.g. "github" for "github/deepseek/DeepSeek-V3-0324" """
+    return deployment["litellm_params"]["model"].split("/", 1)[0]
+
+
+class Lease:
+    """Right to send one request to `deployment`, must be released when the request is finished"""
+    __slots__ = ("deployment", "provider", "key", "acquired_at", "started", "released", "prompt_tokens", "budget_entry")
+
+    def __init__(self, deployment: dict, prompt_tokens: int, budget_entry: list):
+        self.deployment = deployment
+        self.provider = provider_of(deployment)
+        self.key = (self.provider, deployment["litellm_params"].get("api_key"))
+        self.acquired_at = time.monotonic()
+        self.started = False  # a stream was started with the lease, see `stream_with_lease`
+        self.released = False
+        self.prompt_tokens = prompt_tokens
+        self.budget_entry = budget_entry  # reserved tokens in the rpm/tpm budget of the deployment
+
+    @property
+    def deployment_id(self) -> str:
+        return self.deployment["model_info"]["id"]
+
+
+class _Waiter:
+    __slots__ = ("model_name", "user", "cost", "start_tag", "finish_tag", "future", "enqueued_at")
+
+    def __init__(self, model_name: str, user: str, cost: int, start_tag: float, finish_tag: float,
+                 future: asyncio.Future):
+        self.model_name = model_name
+        self.user = user
+        self.cost = cost
+        self.start_tag = start_tag  # virtual times of weighted fair queuing
+        self.finish_tag = finish_tag
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Limits concurrent requests per provider and per API key, and requests and tokens per minute
+    of every deployment (rpm/tpm of providers.yaml) by sliding windows.
+    Requests without a free slot wait in a bounded queue, a full queue is rejected at once.
+    Free slots go to waiting requests by weighted fair queuing over users: every request gets
+    a virtual finish time `max(virtual time, user's last finish) + cost / tier weight`
+    and the smallest one is served first, so a heavy user delays mostly their own requests.
+    """
+
+    def __init__(self, deployments: list,
+                 max_queue_size: int = config.MAX_QUEUE_SIZE,
+                 queue_timeout: float = min(config.QUEUE_TIMEOUT_SECONDS, config.DEFAULT_REQUEST_TIMEOUT_SECONDS),
+                 provider_concurrency: dict = config.PROVIDER_CONCURRENCY,
+                 key_concurrency: int = config.KEY_CONCURRENCY,
+                 max_queue_size_per_user: int = config.MAX_QUEUE_SIZE_PER_USER,
+                 tier_weights: dict = config.TIER_WEIGHTS):
+        self.max_queue_size = max_queue_size
+        self.max_queue_size_per_user = max_queue_size_per_user
+        self.tier_weights = tier_weights
+        self.queue_timeout = queue_timeout
+        self.provider_concurrency = provider_concurrency
+        self.key_concurrency = key_concurrency
+
+        self._deployments = collections.defaultdict(list)  # model name -> deployments
+        self._budgets: dict[str, budgets.SlidingWindowBudget] = {}  # deployment id -> budget
+        for deployment in deployments:
+            self._deployments[deployment["model_name"]].append(deployment)
+            model_info = deployment["model_info"]
+            self._budgets[model_info["id"]] = budgets.SlidingWindowBudget(model_info.get("rpm"), model_info.get("tpm"))
+        self._budget_wakeup: asyncio.TimerHandle | None = None
+        self._next_index = collections.Counter()  # round robin over deployments of a model
+        self._provider_in_flight = collections.Counter()
+        self._key_in_flight = collections.Counter()
+        self._queue: list[_Waiter] = []
+        self._waiting_by_model = collections.Counter()
+        self._waiting_by_user = collections.Counter()
+        self._virtual_time = 0.0
+        self._last_finish_tag: dict[str, float] = {}  # only users with queued requests
+
+        self.avg_wait = 0.0  # EWMA of queue wait of admitted requests, seconds
+        self.max_wait = 0.0
+        self.metrics = {
+            "admitted": 0,
+            "queued": 0,
+            "rejected_queue_full": 0,
+            "rejected_user_queue_full": 0,
+            "timed_out": 0,
+        }
+
+    def _has_slot(self, deployment: dict, tokens: int, now: float) -> bool:
+        provider = provider_of(deployment)
+        provider_limit = self.provider_concurrency.get(provider)
+        if provider_limit is not None and self._provider_in_flight[provider] >= provider_limit:
+            return False
+        if self._key_in_flight[(provider, deployment["litellm_params"].get("api_key"))] >= self.key_concurrency:
+            return False
+        return self._budgets[deployment["model_info"]["id"]].has_room(tokens, now)
+
+    def _try_lease(self, model_name: str, tokens: int, exclude: tuple = ()) -> Lease | None:
+        """Leases the fastest healthy deployment with a free slot and budget, see `routing.HealthTracker`"""
+        now = time.monotonic()
+        deployments = self._deployments[model_name]
+        start = self._next_index[model_name]
+        with_slots = {}
+        for i in range(len(deployments)):
+            deployment = deployments[(start + i) % len(deployments)]
+            if deployment["model_info"]["id"] not in exclude and self._has_slot(deployment, tokens, now):
+                with_slots[deployment["model_info"]["id"]] = deployment
+        chosen = routing.tracker.choose(model_name, list(with_slots)) if with_slots else None
+        if chosen is None:
+            return None
+        self._next_index[model_name] = (start + 1) % len(deployments)
+        budget_entry = self._budgets[chosen].reserve(tokens, now)
+        lease = Lease(with_slots[chosen], max(0, tokens - config.REQUEST_BASE_COST_TOKENS), budget_entry)
+        self._provider_in_flight[lease.provider] += 1
+        self._key_in_flight[lease.key] += 1
+        return lease
+
+    def _record_wait(self, wait: float):
+        self.metrics["admitted"] += 1
+        self.avg_wait = wait if self.metrics["admitted"] == 1 else 0.8 * self.avg_wait + 0.2 * wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_wait))
+
+    async def acquire(self, model_name: str, user: str = "anonymous", tier: str = config.DEFAULT_TIER,
+                      cost: int = config.REQUEST_BASE_COST_TOKENS) -> Lease:
+        """
+        Returns a lease on a deployment of `model_name`, raises `AdmissionError` if there is no slot.
+        `cost` is the size of the request in tokens, the user's share is weighted by `tier`.
+        """
+        if not self._deployments.get(model_name):
+            raise AdmissionError(503, f"No deployments available for model {model_name}", self.retry_after())
+        if not any(routing.tracker.is_available(d["model_info"]["id"]) for d in self._deployments[model_name]):
+            raise AdmissionError(503, f"All deployments of model {model_name} are failing",
+                                 config.CIRCUIT_OPEN_SECONDS)
+
+        # Requests of the same model don't overtake the waiting ones
+        if not self._waiting_by_model[model_name]:
+            lease = self._try_lease(model_name, cost)
+            if lease is not None:
+                self._record_wait(0.0)
+                return lease
+
+        if len(self._queue) >= self.max_queue_size:
+            self.metrics["rejected_queue_full"] += 1
+            raise AdmissionError(429, "Too many requests, queue is full", self.retry_after())
+        if self._waiting_by_user[user] >= self.max_queue_size_per_user:
+            self.metrics["rejected_user_queue_full"] += 1
+            raise AdmissionError(429, "Too many requests of this user in queue", self.retry_after())
+
+        start_tag = max(self._virtual_time, self._last_finish_tag.get(user, 0.0))
+        finish_tag = start_tag + cost / self.tier_weights.get(tier, 1)
+        self._last_finish_tag[user] = finish_tag
+        waiter = _Waiter(model_name, user, cost, start_tag, finish_tag, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        self._waiting_by_model[model_name] += 1
+        self._waiting_by_user[user] += 1
+        self._schedule_budget_wakeup()
+        self.metrics["queued"] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():  # granted right at the deadline
+                return waiter.future.result()
+            self._abandon(waiter)
+            self.metrics["timed_out"] += 1
+            raise AdmissionError(503, "Timed out waiting for a free provider slot", self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self.release(waiter.future.result())
+            else:
+                self._abandon(waiter)
+            raise
+
+    def try_acquire(self, model_name: str, cost: int, exclude: tuple = ()) -> Lease | None:
+        """Lease without waiting for extra requests like hedges, never taken while somebody waits for the model"""
+        if self._waiting_by_model[model_name]:
+            return None
+        return self._try_lease(model_name, cost, exclude)
+
+    def deployment_ids(self, model_name: str) -> list:
+        return [d["model_info"]["id"] for d in self._deployments.get(model_name, [])]
+
+    def release(self, lease: Lease, used_tokens: int | None = None):
+        """Frees the slot, `used_tokens` replaces the estimate reserved in the deployment's budget"""
+        if lease.released:
+            return
+        lease.released = True
+        if not lease.started:
+            # Discarded lease: a probe chosen for it would otherwise stay in flight and keep the deployment ejected
+            routing.tracker.record_abandoned(lease.deployment_id)
+        if used_tokens is not None:
+            self._budgets[lease.deployment_id].correct(lease.budget_entry, used_tokens)
+        self._provider_in_flight[lease.provider] -= 1
+        self._key_in_flight[lease.key] -= 1
+        self._dispatch()
+
+    def _abandon(self, waiter: _Waiter):
+        waiter.future.cancel()
+        self._remove(waiter)
+
+    def _remove(self, waiter: _Waiter):
+        try:
+            self._queue.remove(waiter)
+        except ValueError:
+            return
+        self._waiting_by_model[waiter.model_name] -= 1
+        self._waiting_by_user[waiter.user] -= 1
+        if not self._waiting_by_user[waiter.user]:
+            del self._waiting_by_user[waiter.user]
+            # Idle users start again from the current virtual time
+            self._last_finish_tag.pop(waiter.user, None)
+
+    def _dispatch(self):
+        """Hands free slots to waiters by smallest finish tag, waiters of saturated models are skipped"""
+        now = time.monotonic()
+        for waiter in sorted(self._queue, key=lambda w: w.finish_tag):
+            lease = self._try_lease(waiter.model_name, waiter.cost)
+            if lease is None:
+                continue
+            self._remove(waiter)
+            self._virtual_time = max(self._virtual_time, waiter.start_tag)
+            self._record_wait(now - waiter.enqueued_at)
+            waiter.future.set_result(lease)
+        self._schedule_budget_wakeup()
+
+    def _schedule_budget_wakeup(self):
+        """Budgets free up with time, not on release, so waiters blocked by them need a timer"""
+        if self._budget_wakeup is not None or not self._queue:
+            return
+        now = time.monotonic()
+        # Empty windows don't free up anything with time, waiters blocked by them are woken by a release
+        free_times = (self._budgets[d["model_info"]["id"]].free_at(now)
+                      for model_name in self._waiting_by_model if self._waiting_by_model[model_name]
+                      for d in self._deployments[model_name])
+        free_at = min((t for t in free_times if t is not None), default=None)
+        if free_at is None or free_at <= now:
+            return
+
+        def wakeup():
+            self._budget_wakeup = None
+            self._dispatch()
+
+        self._budget_wakeup = asyncio.get_running_loop().call_later(free_at - now, wakeup)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self._queue),
+            "queue_depth_by_model": {model: n for model, n in self._waiting_by_model.items() if n},
+            "users_waiting": len(self._waiting_by_user),
+            "in_flight_by_provider": {provider: n for provider, n in self._provider_in_flight.items() if n},
+            "budgets": {deployment_id: budget.as_dict() for deployment_id, budget in self._budgets.items()},
+            "avg_wait_ms": round(self.avg_wait * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            **self.metrics,
+        }
+
+
+controller = AdmissionController(res_model_list)
+
+
+async def stream_with_lease(lease: Lease, chunks, timeout: float = config.DEFAULT_REQUEST_TIMEOUT_SECONDS):
+    """
+    Passes `chunks` through, stops after `timeout` seconds and releases the lease when the stream ends.
+    Used tokens (prompt plus about 4 chars per generated token) go to the deployment's budget.
+    """
+    generated_chars = 0
+    lease.started = True
+    try:
+        async for chunk in chunks:
+            generated_chars += len(chunk.text)
+            yield chunk
+            if time.monotonic() - lease.acquired_at > timeout:
+                print(f"Stream of {lease.deployment_id} stopped after {timeout}s")
+                break
+    finally:
+        await chunks.aclose()
+        controller.release(lease, lease.prompt_tokens + generated_chars // 4)
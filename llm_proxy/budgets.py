@@ -0,0 +1,56 @@
+import collections
+import time
+
+BUDGET_WINDOW_SECONDS = 60
+
+
+class SlidingWindowBudget:
+    """
+    Requests and tokens of one API key in the last minute, limited by its rpm and tpm.
+    Tokens are reserved with an estimate when a request starts and corrected when it ends.
+    """
+
+    def __init__(self, rpm: int | None, tpm: int | None, window: float = BUDGET_WINDOW_SECONDS):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._entries: collections.deque[list] = collections.deque()  # [started_at, tokens], oldest first
+        self.tokens = 0
+
+    def _expire(self, now: float):
+        while self._entries and now - self._entries[0][0] >= self.window:
+            self.tokens -= self._entries.popleft()[1]
+
+    def has_room(self, tokens: int, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        if self.rpm is not None and len(self._entries) >= self.rpm:
+            return False
+        # A request bigger than the whole tpm may still go to an idle key
+        if self.tpm is not None and self.tokens and self.tokens + tokens > self.tpm:
+            return False
+        return True
+
+    def reserve(self, tokens: int, now: float | None = None) -> list:
+        entry = [time.monotonic() if now is None else now, tokens]
+        self._entries.append(entry)
+        self.tokens += tokens
+        return entry
+
+    def correct(self, entry: list, tokens: int):
+        """Replaces the estimate of a reserved entry with the real usage"""
+        now = time.monotonic()
+        self._expire(now)
+        if now - entry[0] < self.window:  # still counted
+            self.tokens += tokens - entry[1]
+        entry[1] = tokens
+
+    def free_at(self, now: float | None = None) -> float | None:
+        """Monotonic time when the oldest entry leaves the window, None for an empty window"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        return self._entries[0][0] + self.window if self._entries else None
+
+    def as_dict(self) -> dict:
+        self._expire(time.monotonic())
+        return {"rpm": self.rpm, "tpm": self.tpm, "requests": len(self._entries), "tokens": self.tokens}
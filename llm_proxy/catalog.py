@@ -0,0 +1,34 @@
+import hashlib
+import json
+import os
+
+import config
+from load_data import res_model_list
+
+# OpenAI-compatible model list, built once: the deployment table doesn't change while the proxy runs.
+# `created` is the time of providers.yaml, so every worker serves the same body and ETag.
+_created = int(os.path.getmtime("providers.yaml"))
+
+models = {
+    "object": "list",
+    "data": [
+        {
+            "id": model["name"],
+            "object": "model",
+            "created": _created,
+            "owned_by": "llm_proxy",
+            "name": config.MODEL_DISPLAY_NAMES.get(model["name"], model["name"]),
+            "providers": model["providers"],
+        }
+        for model in config.get_available_models_list(res_model_list)
+    ],
+}
+body = json.dumps(models, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def is_fresh(if_none_match: str | None) -> bool:
+    """True if the client's If-None-Match has the current ETag, so 304 is enough"""
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
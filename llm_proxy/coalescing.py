@@ -0,0 +1,65 @@
+import asyncio
+
+import config
+import events
+
+_END = object()
+
+
+async def _pump(chunks, queue: asyncio.Queue):
+    try:
+        async for chunk in chunks:
+            queue.put_nowait(chunk)
+        queue.put_nowait(_END)
+    except Exception as error:
+        queue.put_nowait(error)
+    finally:
+        await chunks.aclose()
+
+
+async def coalesce(chunks,
+                   max_delay: float = config.COALESCE_MAX_DELAY_SECONDS,
+                   max_chars: int = config.COALESCE_MAX_CHARS):
+    """
+    Merges consecutive deltas of one kind into one: a merged delta is sent `max_delay` seconds after
+    its first part arrived or as soon as it has `max_chars`. The first delta and the switch between
+    reasoning and content are never held back. The upstream is read by its own task, so a timer can
+    flush while it waits for the provider.
+    """
+    if max_delay <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    queue = asyncio.Queue()
+    pump = asyncio.create_task(_pump(chunks, queue))
+    loop = asyncio.get_running_loop()
+    try:
+        item = await queue.get()
+        if isinstance(item, events.Delta):
+            yield item  # time to first token is not delayed
+            item = await queue.get()
+        while isinstance(item, events.Delta):
+            kind = item.kind
+            texts = [item.text]
+            size = len(item.text)
+            deadline = loop.time() + max_delay
+            item = None
+            while size < max_chars:
+                try:
+                    item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    item = None
+                    break
+                if not isinstance(item, events.Delta) or item.kind != kind:
+                    break
+                texts.append(item.text)
+                size += len(item.text)
+                item = None
+            yield events.Delta(kind, "".join(texts))
+            if item is None:
+                item = await queue.get()
+        if isinstance(item, Exception):
+            raise item
+    finally:
+        pump.cancel()
@@ -78,95 +78,118 @@ PROVIDER_PRIORITY = [
     # "azure_openai_canada"
 ]
 
-# FR7.2.2: Parameters for queue (to be implemented later)
-MAX_QUEUE_SIZE = 100
+# FR7.2.2: Parameters for queue (enforced by admission.py)
+MAX_QUEUE_SIZE = 100  # Requests waiting for a free provider slot, more are rejected with 429
 DEFAULT_REQUEST_TIMEOUT_SECONDS = 300 # Default timeout for requests in queue or processing
+QUEUE_TIMEOUT_SECONDS = 30  # Requests waiting longer are rejected with 503, capped by DEFAULT_REQUEST_TIMEOUT_SECONDS
+
+# FR7.2.2: For each Provider – max number of concurrent requests (semaphore logic in admission.py)
+# Keys are provider prefixes of litellm model names in providers.yaml ("github/..." -> "github").
+# Providers that are not listed are limited only by KEY_CONCURRENCY.
+PROVIDER_CONCURRENCY = {
+    "github": 8,
+    "openrouter": 16,
+}
+# Max number of concurrent requests with one API key of a provider
+KEY_CONCURRENCY = 4
+
+# Fair-share scheduling of the queue (weighted fair queuing by the "user" field of requests)
+# Users get provider slots in proportion to the weight of their "tier", a user with many
+# long requests waits behind their own requests instead of everybody else's.
+TIER_WEIGHTS = {
+    "free": 1,
+    "premium": 4,
+}
+DEFAULT_TIER = "free"
+MAX_QUEUE_SIZE_PER_USER = 10  # Queued requests of one user, more are rejected with 429
+REQUEST_BASE_COST_TOKENS = 500  # Expected answer size, added to the prompt size to get the cost of a request
+
+# Exact-match response cache (response_cache.py), used for requests with "cache": true
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+RESPONSE_CACHE_MAX_ITEMS = 1000  # In-memory tier
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_DIR = "cache/responses"  # On-disk tier, None disables it
+RESPONSE_CACHE_DISK_MAX_BYTES = 512 * 1024 * 1024
+RESPONSE_CACHE_REPLAY_CHARS_PER_SECOND = 300  # Pacing of cache hits, 0 sends everything at once
+RESPONSE_CACHE_REPLAY_MAX_DELAY_SECONDS = 0.5  # Max pause between two replayed chunks
+
+# Identical requests that arrive while a generation is running subscribe to it instead of starting their own
+SINGLE_FLIGHT_ENABLED = True
+
+# Rate limits of callers (ratelimit.py): token buckets per API key and per end user ("user" of a request),
+# refilled every minute, None disables a bucket. Kept in the memory of the process, so run one proxy process.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_KEY_RPM = 600
+RATE_LIMIT_KEY_TPM = 2_000_000
+RATE_LIMIT_USER_RPM = 20
+RATE_LIMIT_USER_TPM = 200_000
+RATE_LIMIT_SWEEP_SECONDS = 60  # How often buckets of idle callers are dropped
+
+# Provider deltas (often a single token) are merged before they are sent, see coalescing.py
+COALESCE_MAX_DELAY_SECONDS = 0.05  # 0 disables merging
+COALESCE_MAX_CHARS = 1024
+
+# Models that stream reasoning in the content and end it with this separator instead of a reasoning field
+REASONING_SEPARATORS = {
+    "phi-4-reasoning": "───",
+}
+
+# Deployment routing (routing.py): the fastest healthy deployment by EWMA statistics gets the request
+ROUTING_EWMA_ALPHA = 0.3  # Weight of the newest sample
+ROUTING_TYPICAL_ANSWER_CHARS = 2000  # Expected latency = time to first token + this / throughput
+ROUTING_MIN_THROUGHPUT_CHARS = 200  # Shorter answers don't update the throughput
+ROUTING_DEFAULT_TTFT_SECONDS = 2  # Assumed for deployments that failed before their first token
+ROUTING_ERROR_PENALTY = 4  # Expected latency is multiplied by (1 + penalty * error rate)
+ROUTING_DECISIONS_KEPT = 100  # Recent routing decisions shown by /health
+ROUTING_TTFT_SAMPLES = 200  # Recent times to first token kept per deployment for percentiles
+CIRCUIT_FAILURE_THRESHOLD = 3  # Failures in a row that eject a deployment
+CIRCUIT_OPEN_SECONDS = 30  # Time before an ejected deployment gets a probe request
+
+# Hedged requests (hedging.py): without a first token after the HEDGE_PERCENTILE of recent times
+# to first token, the same request also goes to another deployment and the first one to answer wins
+HEDGING_ENABLED = True
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_SAMPLES = 20  # Fewer samples use HEDGE_DEFAULT_DELAY_SECONDS
+HEDGE_DEFAULT_DELAY_SECONDS = 5
+HEDGE_MIN_DELAY_SECONDS = 1
+HEDGE_BUDGET_RATIO = 0.1  # Hedges are limited to this part of requests
+HEDGE_BUDGET_BURST = 5  # Hedges that can be spent at once after a quiet period
+
+# /v1/models (catalog.py)
+MODEL_DISPLAY_NAMES = {  # Names shown to users, other models are shown by id
+    "qwen3-235b-a22b": "Qwen 3 235B",
+    "llama-4-maverick": "Llama 4 Maverick",
+    "deepseek-r1": "DeepSeek R1",
+    "deepseek-v3": "DeepSeek V3",
+    "ministral-3b": "Ministral 3B",
+    "phi-4-reasoning": "Phi 4 Reasoning",
+}
+MODELS_MAX_AGE_SECONDS = 300  # Cache-Control max-age of the catalog, clients revalidate with ETag afterwards
+
+# Sampling parameters forwarded to the provider, they are part of the response cache and single-flight keys
+GENERATION_PARAMS = ("temperature", "top_p", "max_tokens", "stop", "presence_penalty", "frequency_penalty", "seed")
+# Other fields of /v1/chat/completions requests, the rest is rejected with 400 (usage is always sent)
+CHAT_COMPLETION_FIELDS = {"model", "messages", "stream", "stream_options", "user", "tier", "cache"}
 
-# FR7.2.2: For each Provider – number of API keys (for managing internal semaphore logic)
-# This is for more advanced concurrency control per provider, beyond LiteLLM's default key rotation.
-# For now, we rely on LiteLLM's handling of multiple keys in env vars (e.g., OPENAI_API_KEY="k1,k2").
-# Example:
-# PROVIDER_CONCURRENCY = {
-#     "openai": 2, # Max 2 concurrent requests to OpenAI provider using its configured keys
-#     "anthropic": 1,
-#     "groq": 5
-# }
-# This feature (semaphore logic) will be implemented in a later stage.
 
 # FR6.2: Structure for /v1/models endpoint
-# This function transforms CONFIGURED_PROVIDERS into the desired output format.
-def get_available_models_list():
+def get_available_models_list(deployments: list):
     """
-    Generates a list of available models based on CONFIGURED_PROVIDERS
-    for the /v1/models endpoint.
+    Groups the deployment table (load_data.res_model_list) by model name
+    with the providers serving each model, sorted by name.
     """
-    model_map = {} # To group providers by model name
-    # First, collect all models and the providers that list them
-    for provider_key, provider_config in CONFIGURED_PROVIDERS.items():
-        provider_name_for_output = provider_key # Use the key from CONFIGURED_PROVIDERS as the identifier
-        for model_name in provider_config.get("models", []):
-            # Handle models that might be listed with provider prefix in config (e.g. "openai/gpt-4o")
-            # For the output, we want the base model name and a list of providers.
-            base_model_name = model_name.split('/')[-1]
-
-            if base_model_name not in model_map:
-                model_map[base_model_name] = {"name": base_model_name, "providers": set()}
-            model_map[base_model_name]["providers"].add(provider_name_for_output)
-
-    # Also, consider models that might be specified with a provider prefix in the config
-    # e.g. if a user explicitly configures "openai/gpt-4o" as a distinct entry.
-    # The current logic correctly extracts "gpt-4o" as base_model_name.
-
-    # Convert sets of providers to lists for JSON output
-    available_models = []
-    for model_info in model_map.values():
-        model_info["providers"] = sorted(list(model_info["providers"]))
-        available_models.append(model_info)
-    
-    # Add models that are configured with an explicit provider prefix,
-    # ensuring they are also listed as per FR6.2 example like "openai/gpt-3.5-turbo"
-    for provider_key, provider_config in CONFIGURED_PROVIDERS.items():
-        provider_name_for_output = provider_key
-        for model_name in provider_config.get("models", []):
-            if '/' in model_name: # e.g., "openai/gpt-3.5-turbo"
-                # Check if this specific prefixed entry is already effectively covered
-                # by the base model name logic. If not, or if we want to be explicit:
-                is_already_listed_explicitly = any(
-                    m["name"] == model_name and provider_name_for_output in m["providers"]
-                    for m in available_models
-                )
-                if not is_already_listed_explicitly:
-                    # Ensure it's added if it represents a distinct way to call a model
-                    # (though typically LiteLLM handles provider from the model string if prefixed)
-                    # For FR6.2, if "openai/gpt-3.5-turbo" is in config, it should be listed.
-                    # The current model_map logic uses base names. We might need to adjust
-                    # if the requirement is to list *exactly* as in config plus the grouped ones.
-
-                    # Let's refine: the output should list unique model *identifiers* that can be used in requests.
-                    # If "openai/gpt-4o" is a configured model string, it should be listed.
-                    # If "gpt-4o" is also configured under "openai", it's effectively the same for this provider.
-
-                    # The FR6.2 example shows:
-                    # {"name": "gpt-4", "providers": ["openai", "azure_openai"]},
-                    # {"name": "openai/gpt-3.5-turbo", "providers": ["openai"]},
-                    # This implies that "name" can be a base name OR a prefixed name.
-
-                    # Let's stick to the initial model_map logic which groups by base model name,
-                    # and then add any explicitly prefixed models from the config if they aren't
-                    # already represented for that provider.
-
-                    # Re-thinking FR6.2: "Список моделей, которые Сервер может попытаться использовать"
-                    # This means all unique model strings defined in the config.
-                    pass # The current logic for model_map should be sufficient if users query by base model name.
-                         # If they query by "openai/gpt-4o", our server logic (FR2) will handle that.
-                         # The /v1/models endpoint is more about discoverability of what base models exist and where.
-
-    # Sort the final list by model name for consistent output
-    return sorted(available_models, key=lambda x: x["name"])
+    model_map = {}
+    for deployment in deployments:
+        model_name = deployment["model_name"]
+        provider = deployment["litellm_params"]["model"].split("/", 1)[0]
+        model_map.setdefault(model_name, set()).add(provider)
+    return [{"name": name, "providers": sorted(providers)} for name, providers in sorted(model_map.items())]
+
 
 if __name__ == '__main__':
     # For testing the config functions
-    print("Configured Providers:", CONFIGURED_PROVIDERS)
+    from load_data import res_model_list
     print("\nAvailable Models for /v1/models endpoint:")
-    for model_data in get_available_models_list():
+    for model_data in get_available_models_list(res_model_list):
         print(model_data)
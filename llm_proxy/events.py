@@ -0,0 +1,93 @@
+import json
+import typing
+
+# Stream protocol between the proxy and its clients: one JSON frame per line (NDJSON).
+#   {"type": "reasoning", "text": "..."}  reasoning delta
+#   {"type": "content", "text": "..."}    answer delta
+#   {"type": "usage", "prompt_tokens": n, "completion_tokens": n, "total_tokens": n}  sent before `done`/`error`
+#   {"type": "error", "message": "..."}   the stream failed after it started, no `done` follows
+#   {"type": "done"}                      the stream finished normally
+PROTOCOL_VERSION = "1"
+PROTOCOL_HEADER = "X-Stream-Protocol"
+MIMETYPE = "application/x-ndjson"
+
+REASONING = "reasoning"
+CONTENT = "content"
+USAGE = "usage"
+ERROR = "error"
+DONE = "done"
+
+THINK_TAG_START = "<think>"
+THINK_TAG_END = "</think>"
+
+
+class Delta(typing.NamedTuple):
+    kind: str  # REASONING or CONTENT
+    text: str
+
+
+def frame(frame_type: str, **fields) -> str:
+    return json.dumps({"type": frame_type, **fields}, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+async def encode(deltas, usage=None):
+    """
+    NDJSON frames of `deltas` ending with `done`, an exception in the middle of the stream becomes an `error` frame.
+    `usage` is an async function of the generated text that returns the `usage` frame fields.
+    """
+    texts = []
+    error_frame = None
+    try:
+        async for delta in deltas:
+            if usage is not None:
+                texts.append(delta.text)
+            yield frame(delta.kind, text=delta.text)
+    except Exception as error:
+        print(f"Stream failed: {type(error).__name__}: {error}")
+        error_frame = frame(ERROR, message=f"{type(error).__name__}: {str(error)[:500]}")
+    finally:
+        # The server closes only this generator when the client disconnects, the generation must stop too
+        await deltas.aclose()
+    if usage is not None:
+        yield frame(USAGE, **await usage("".join(texts)))
+    yield error_frame or frame(DONE)
+
+
+def _tag_prefix_length(text: str, tag: str) -> int:
+    """Length of the longest end of `text` that can start `tag`"""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-length:]):
+            return length
+    return 0
+
+
+async def split_think_tags(deltas):
+    """
+    Turns <think>...</think> in content deltas into reasoning deltas, for models without a separate
+    reasoning field. A tag split between deltas is held back until the next one.
+    """
+    in_think = False
+    pending = ""
+    async for delta in deltas:
+        if delta.kind != CONTENT:
+            yield delta
+            continue
+        if "<" not in delta.text and not pending:
+            yield Delta(REASONING, delta.text) if in_think else delta
+            continue
+        text = pending + delta.text
+        while True:
+            tag = THINK_TAG_END if in_think else THINK_TAG_START
+            position = text.find(tag)
+            if position == -1:
+                break
+            if position:
+                yield Delta(REASONING if in_think else CONTENT, text[:position])
+            in_think = not in_think
+            text = text[position + len(tag):]
+        held = _tag_prefix_length(text, THINK_TAG_END if in_think else THINK_TAG_START)
+        pending = text[len(text) - held:] if held else ""
+        if len(text) > held:
+            yield Delta(REASONING if in_think else CONTENT, text[:len(text) - held])
+    if pending:
+        yield Delta(REASONING if in_think else CONTENT, pending)
@@ -0,0 +1,132 @@
+import asyncio
+
+import admission
+import config
+import routing
+
+
+class HedgeBudget:
+    """Token bucket of hedges: every request adds `ratio`, every hedge takes 1"""
+
+    def __init__(self, ratio: float = config.HEDGE_BUDGET_RATIO, burst: float = config.HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.credits = burst
+
+    def on_request(self):
+        self.credits = min(self.burst, self.credits + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.credits < 1:
+            return False
+        self.credits -= 1
+        return True
+
+
+budget = HedgeBudget()
+metrics = {
+    "hedged": 0,
+    "hedge_wins": 0,
+    "skipped_no_budget": 0,
+    "skipped_no_deployment": 0,
+}
+
+
+def can_hedge(model_name: str) -> bool:
+    return config.HEDGING_ENABLED and len(admission.controller.deployment_ids(model_name)) > 1
+
+
+def hedge_delay(model_name: str) -> float:
+    """Percentile of recent times to first token of the model's deployments"""
+    delay = routing.tracker.ttft_percentile(admission.controller.deployment_ids(model_name),
+                                            config.HEDGE_PERCENTILE, config.HEDGE_MIN_SAMPLES)
+    return max(config.HEDGE_MIN_DELAY_SECONDS, delay if delay is not None else config.HEDGE_DEFAULT_DELAY_SECONDS)
+
+
+class _Attempt:
+    """One upstream stream read by its own task, so the loser can be cancelled at any point"""
+
+    def __init__(self, lease: admission.Lease, chunks):
+        self.lease = lease
+        self.first = asyncio.get_running_loop().create_future()  # first ("chunk" | "end" | "error", value)
+        self.queue = asyncio.Queue()  # the following items
+        self.task = asyncio.create_task(self._pump(chunks))
+
+    def _put(self, item: tuple):
+        if not self.first.done():
+            self.first.set_result(item)
+        else:
+            self.queue.put_nowait(item)
+
+    async def _pump(self, chunks):
+        try:
+            async for chunk in chunks:
+                self._put(("chunk", chunk))
+            self._put(("end", None))
+        except Exception as error:
+            self._put(("error", error))
+        finally:
+            await chunks.aclose()
+
+    def cancel(self):
+        self.task.cancel()
+
+
+async def _race(attempts: list, timeout: float | None) -> _Attempt | None:
+    """First attempt with a chunk or a normal end, an error wins only if every attempt failed"""
+    waiting = {attempt.first: attempt for attempt in attempts}
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while waiting:
+        done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED,
+                                     timeout=None if deadline is None else max(0.0, deadline - loop.time()))
+        if not done:
+            return None
+        for future in done:
+            attempt = waiting.pop(future)
+            if future.result()[0] != "error" or not waiting:
+                return attempt
+    return None
+
+
+async def hedged(model_name: str, cost: int, lease: admission.Lease, start):
+    """
+    Streams `start(lease)`. If it has no first chunk after `hedge_delay`, `start` is also called
+    with a lease on another deployment of the model. The first attempt to produce a chunk wins,
+    the other one is cancelled and its lease released.
+    """
+    budget.on_request()
+    attempts = [_Attempt(lease, start(lease))]
+    try:
+        winner = await _race(attempts, hedge_delay(model_name))
+        if winner is None:
+            hedge_lease = None
+            if not budget.try_spend():
+                metrics["skipped_no_budget"] += 1
+            else:
+                hedge_lease = admission.controller.try_acquire(model_name, cost, exclude=(lease.deployment_id,))
+                if hedge_lease is None:
+                    budget.credits += 1  # not spent
+                    metrics["skipped_no_deployment"] += 1
+            if hedge_lease is not None:
+                metrics["hedged"] += 1
+                attempts.append(_Attempt(hedge_lease, start(hedge_lease)))
+            winner = await _race(attempts, None)
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+        if winner is not attempts[0]:
+            metrics["hedge_wins"] += 1
+
+        kind, value = winner.first.result()
+        while kind == "chunk":
+            yield value
+            kind, value = await winner.queue.get()
+        if kind == "error":
+            raise value
+    finally:
+        # Also when the client leaves during the race: every attempt holds a lease and an upstream stream
+        for attempt in attempts:
+            attempt.cancel()
+        await asyncio.gather(*(attempt.task for attempt in attempts), return_exceptions=True)
@@ -1,3 +1,4 @@
+import copy
 import yaml
 import json
 import os
@@ -6,21 +7,31 @@ import os
 with open("providers.yaml", "r") as f:
     model_list = yaml.safe_load(f)
 
+# Deployment table: one independent deployment per API key.
+# `model_info` holds a stable id (used to pin requests) and the rpm/tpm budget of the key.
 res_model_list = []
 
 for model in model_list:
-    api_key_env = model["litellm_params"].pop("api_key_env")
-    # model["litellm_params"]["api_key"] = os.getenv(api_key_env)
-
-    # print(os.getenv(api_key_env))
-    # print(type(os.getenv(api_key_env)))
-    api_keys_list = json.loads(os.getenv(api_key_env))
-    if '[' not in os.getenv(api_key_env):
+    api_key_env = model["litellm_params"].get("api_key_env")
+    api_keys_json = os.getenv(api_key_env) if api_key_env else None
+    if not api_keys_json or '[' not in api_keys_json:
+        print(f"Skipping {model['model_name']} ({model['litellm_params']['model']}): {api_key_env} is not a JSON list")
         continue
+    api_keys_list = json.loads(api_keys_json)
     for api_key in api_keys_list:
-        model_copy = model.copy()
-        model_copy["litellm_params"]["api_key"] = api_key
-        res_model_list.append(model_copy)
+        # Deep copy, otherwise all keys of an entry would share one litellm_params dict
+        deployment = {
+            "model_name": model["model_name"],
+            "litellm_params": copy.deepcopy(model["litellm_params"]),
+        }
+        deployment["litellm_params"].pop("api_key_env", None)
+        deployment["litellm_params"]["api_key"] = api_key
+        deployment["model_info"] = {
+            "id": f"{model['model_name']}/{model['litellm_params']['model']}/{len(res_model_list)}",
+            "rpm": model.get("rpm"),  # None means no limit
+            "tpm": model.get("tpm"),
+        }
+        res_model_list.append(deployment)
 
 unique_model_names = set(m["model_name"] for m in model_list)
 
@@ -28,4 +39,4 @@ fallbacks = []
 for model in unique_model_names:
     fallbacks.append({
         model: [m["litellm_params"]["model"] for m in res_model_list if m["model_name"] == model]
-    })
\ No newline at end of file
+    })
@@ -1,20 +1,32 @@
-from flask import Flask, Response, request, abort
+from quart import Quart, Response, request, abort, jsonify
 import time
 import dotenv
 
 from pprint import pprint
-from litellm import completion, stream_chunk_builder
 import litellm
 import os
 
 from utils import *
+import admission
+import catalog
+import coalescing
+import config
+import events
+import hedging
+import openai_compat
+import ratelimit
+import response_cache
+import routing
 from load_data import model_list, fallbacks
 
 dotenv.load_dotenv(override=True)
 
 litellm.force_ipv4 = True
 
-app = Flask(__name__)
+app = Quart(__name__)
+# Generations can stream for minutes, the default limits of Quart would cut them off
+app.config["RESPONSE_TIMEOUT"] = None
+app.config["BODY_TIMEOUT"] = 60
 
 
 
@@ -24,32 +36,166 @@ messages = [
 
 
 
+def stream_response(chunks, usage=None) -> Response:
+    return Response(events.encode(chunks, usage), mimetype=events.MIMETYPE,
+                    headers={events.PROTOCOL_HEADER: events.PROTOCOL_VERSION})
+
+
+@app.errorhandler(admission.AdmissionError)
+async def admission_error(error: admission.AdmissionError):
+    return Response(error.message, status=error.status, headers={"Retry-After": str(error.retry_after)})
+
+
+async def admitted_chunks(model: str, messages: list, user: str = "anonymous",
+                          tier: str = config.DEFAULT_TIER, use_cache: bool = False, params: dict | None = None):
+    """
+    Waits for a provider slot and starts the generation, errors before the first chunk are raised here
+    and so are not hidden behind 200. Returns an async iterator of `events.Delta`s.
+    """
+    use_cache = use_cache and config.RESPONSE_CACHE_ENABLED
+    key = response_cache.cache_key(model, messages, params)
+    if use_cache:
+        cached_chunks = await response_cache.cache.get(key)
+        if cached_chunks is not None:
+            return response_cache.replay(cached_chunks)
+
+    chunks = join_generation(key) if config.SINGLE_FLIGHT_ENABLED else None
+    if chunks is None:
+        lease = await admission.controller.acquire(model, user, tier, request_cost(messages))
+        # An identical request could start while this one was waiting in the queue
+        chunks = join_generation(key) if config.SINGLE_FLIGHT_ENABLED else None
+        if chunks is not None:
+            admission.controller.release(lease, 0)
+        else:
+            def start(lease: admission.Lease):
+                chunks = routing.observe(lease.deployment_id, generate(model, messages, lease.deployment_id, params))
+                chunks = coalescing.coalesce(chunks)
+                if use_cache:
+                    chunks = response_cache.record(key, chunks)
+                # Started generator releases the lease in its `finally` even if the client never reads the body
+                return admission.stream_with_lease(lease, chunks)
+
+            if hedging.can_hedge(model):
+                chunks = hedging.hedged(model, request_cost(messages), lease, start)
+            else:
+                chunks = start(lease)
+            if config.SINGLE_FLIGHT_ENABLED:
+                chunks = share_generation(key, chunks)
+    try:
+        first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+
+    async def body():
+        try:
+            if first_chunk is None:
+                return
+            yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return body()
+
+
+async def admitted_stream(model: str, messages: list, user: str = "anonymous",
+                          tier: str = config.DEFAULT_TIER, use_cache: bool = False) -> Response:
+    """Streams the generation as NDJSON frames, errors after the start end it with an `error` frame"""
+    chunks = await admitted_chunks(model, messages, user, tier, use_cache)
+    return stream_response(chunks, usage=lambda completion: count_usage(model, messages, completion))
+
+
+async def caller_chunks(data: dict):
+    """
+    Rate limits the caller of a valid request and starts its generation. Returns the chunks and the usage
+    function of the stream, which also replaces the estimated tokens in the caller's buckets with the counted ones.
+    """
+    model = data["model"]
+    messages = data["messages"]
+    user, tier = request_identity(data)
+    end_user = str(data["user"]) if "user" in data else None
+    params = generation_params(data)
+    estimated_tokens = request_cost(messages)
+    if config.RATE_LIMIT_ENABLED:
+        ratelimit.limiter.acquire(data["api_key"], end_user, estimated_tokens)
+    try:
+        chunks = await admitted_chunks(model, messages, user, tier, use_cache=data.get("cache", False), params=params)
+    except BaseException:
+        if config.RATE_LIMIT_ENABLED:
+            ratelimit.limiter.correct(data["api_key"], end_user, estimated_tokens, 0)
+        raise
+
+    async def usage(completion: str) -> dict:
+        counted = await count_usage(model, messages, completion)
+        if config.RATE_LIMIT_ENABLED:
+            ratelimit.limiter.correct(data["api_key"], end_user, estimated_tokens, counted["total_tokens"])
+        return counted
+
+    return chunks, usage
+
+
 @app.route("/stream/<string:model>")
-def stream2(model: str):
-    return Response(generate(model), mimetype="text/plain")
+async def stream2(model: str):
+    return await admitted_stream(model, messages)
 
 @app.route("/stream/", methods=["POST"])
-def stream():
+async def stream():
     if not request.is_json:
-        print(request.get_data())
-        print(request.get_json())
-        print(request.content_encoding)
         return abort(415, "Unsupported Media Type: Request must be JSON")
     
-    data = request.get_json()
-    print(data)
+    data = await request.get_json()
     if not data or not valid_model_request(data):
         return abort(400, "Bad Request: Invalid JSON data")
-    
-    if valid_model_request(data):
-        model = data["model"]
-        messages = data["messages"]
 
-        return Response(generate(model, messages), mimetype="text/plain")
+    chunks, usage = await caller_chunks(data)
+    return stream_response(chunks, usage)
+
+
+@app.route("/v1/models")
+async def list_models():
+    check_api_key(bearer_api_key(request))
+    headers = {"ETag": catalog.etag, "Cache-Control": f"private, max-age={config.MODELS_MAX_AGE_SECONDS}"}
+    if catalog.is_fresh(request.headers.get("If-None-Match")):
+        return Response(status=304, headers=headers)
+    return Response(catalog.body, mimetype="application/json", headers=headers)
+
+@app.route("/v1/chat/completions", methods=["POST"])
+async def chat_completions():
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return abort(400, "Bad Request: Invalid JSON data")
+    unknown_fields = set(data) - config.CHAT_COMPLETION_FIELDS - set(config.GENERATION_PARAMS)
+    data["api_key"] = bearer_api_key(request)
+    valid_model_request(data)
+    if unknown_fields:
+        return abort(400, f"Unsupported fields: {', '.join(sorted(unknown_fields))}")
+    if not isinstance(data.get("stream", False), bool):
+        return abort(400, "Stream should be a boolean")
+
+    model = data["model"]
+    chunks, usage = await caller_chunks(data)
+    if not data.get("stream"):
+        return jsonify(await openai_compat.completion(model, chunks, usage))
+    return Response(openai_compat.sse_stream(model, chunks, usage), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/metrics")
+async def metrics():
+    return jsonify(admission=admission.controller.stats(), response_cache=response_cache.cache.stats(),
+                   shared_generations=len(shared_generations),
+                   hedging={**hedging.metrics, "budget": round(hedging.budget.credits, 2)},
+                   rate_limits=ratelimit.limiter.stats())
+
+@app.route("/health")
+async def health():
+    return jsonify(routing.tracker.stats())
 
 @app.route("/")
-def strm():
+async def strm():
     return "Work"
 
 if __name__ == "__main__":
+    # Development server, for production run an ASGI server: hypercorn main:app --bind 127.0.0.1:5050
     app.run(port=5050)
\ No newline at end of file
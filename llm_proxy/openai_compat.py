@@ -0,0 +1,72 @@
+import json
+import time
+import uuid
+
+import events
+
+# Streams of the OpenAI chat completions API built from `events.Delta`s, see /v1/chat/completions
+
+
+def _completion_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex}"
+
+
+def _sse(data) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+def _delta_fields(delta: events.Delta) -> dict:
+    return {"reasoning_content": delta.text} if delta.kind == events.REASONING else {"content": delta.text}
+
+
+async def sse_stream(model: str, deltas, usage):
+    """
+    `chat.completion.chunk` server-sent events ending with `[DONE]`, a failure mid-stream sends an error event.
+    The last chunk has `usage`, an async function of the generated text.
+    """
+    completion_id = _completion_id()
+    created = int(time.time())
+
+    def chunk(delta: dict, finish_reason: str | None = None, **fields) -> str:
+        return _sse({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **fields,
+        })
+
+    texts = []
+    yield chunk({"role": "assistant"})
+    try:
+        async for delta in deltas:
+            texts.append(delta.text)
+            yield chunk(_delta_fields(delta))
+    except Exception as error:
+        print(f"Stream failed: {type(error).__name__}: {error}")
+        yield _sse({"error": {"message": f"{type(error).__name__}: {str(error)[:500]}", "type": "upstream_error"}})
+        return
+    finally:
+        await deltas.aclose()  # stops the generation when the client disconnects
+    yield chunk({}, "stop", usage=await usage("".join(texts)))
+    yield "data: [DONE]\n\n"
+
+
+async def completion(model: str, deltas, usage) -> dict:
+    """Whole `chat.completion` object of a non-streaming request"""
+    content = []
+    reasoning = []
+    async for delta in deltas:
+        (reasoning if delta.kind == events.REASONING else content).append(delta.text)
+    message = {"role": "assistant", "content": "".join(content)}
+    if reasoning:
+        message["reasoning_content"] = "".join(reasoning)
+    return {
+        "id": _completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+        "usage": await usage("".join(reasoning + content)),
+    }
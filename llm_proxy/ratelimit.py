@@ -0,0 +1,113 @@
+import hashlib
+import math
+import time
+
+import admission
+import config
+
+
+class TokenBucket:
+    """Holds up to `capacity` units and refills `capacity` per `period` seconds"""
+
+    def __init__(self, capacity: float, period: float = 60.0, now: float | None = None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated_at = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken, 0 if it can be taken now"""
+        self._refill(now)
+        # A request bigger than the bucket waits for a full bucket instead of being rejected forever
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        # Negative level is a debt that delays later requests, refunds (negative amount) don't overfill
+        self.level = min(self.capacity, self.level - amount)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.level >= self.capacity
+
+
+def caller_id(api_key: str) -> str:
+    """Short hash of an API key, raw keys are not kept in memory or shown in metrics"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class RateLimiter:
+    """
+    Request and token buckets per API key and per end user of a key.
+    A request is admitted only if all its buckets have room, then it takes from all of them.
+    Token costs are estimated before the generation and corrected with the counted usage after it.
+    """
+
+    def __init__(self,
+                 key_rpm: int | None = config.RATE_LIMIT_KEY_RPM,
+                 key_tpm: int | None = config.RATE_LIMIT_KEY_TPM,
+                 user_rpm: int | None = config.RATE_LIMIT_USER_RPM,
+                 user_tpm: int | None = config.RATE_LIMIT_USER_TPM):
+        self.limits = {
+            ("key", "requests"): key_rpm,
+            ("key", "tokens"): key_tpm,
+            ("user", "requests"): user_rpm,
+            ("user", "tokens"): user_tpm,
+        }
+        self._buckets: dict[tuple, TokenBucket] = {}
+        self._swept_at = time.monotonic()
+        self.metrics = {"admitted": 0, "rejected": 0}
+
+    def _bucket_ids(self, api_key: str, user: str | None) -> list[tuple]:
+        caller = caller_id(api_key)
+        scopes = [("key", caller)] + ([("user", caller, user)] if user is not None else [])
+        return [(scope, kind) for scope in scopes for kind in ("requests", "tokens")
+                if self.limits[(scope[0], kind)]]
+
+    def _bucket(self, bucket_id: tuple, now: float) -> TokenBucket:
+        bucket = self._buckets.get(bucket_id)
+        if bucket is None:
+            scope, kind = bucket_id
+            bucket = self._buckets[bucket_id] = TokenBucket(self.limits[(scope[0], kind)], now=now)
+        return bucket
+
+    def acquire(self, api_key: str, user: str | None, tokens: int):
+        """Takes one request and `tokens` from the caller's buckets or raises `AdmissionError` 429"""
+        now = time.monotonic()
+        self._sweep(now)
+        buckets = [(bucket_id[1], self._bucket(bucket_id, now)) for bucket_id in self._bucket_ids(api_key, user)]
+        wait = max((bucket.wait_time(1 if kind == "requests" else tokens, now) for kind, bucket in buckets),
+                   default=0.0)
+        if wait > 0:
+            self.metrics["rejected"] += 1
+            raise admission.AdmissionError(429, "Rate limit exceeded, retry later", math.ceil(wait))
+        for kind, bucket in buckets:
+            bucket.take(1 if kind == "requests" else tokens)
+        self.metrics["admitted"] += 1
+
+    def correct(self, api_key: str, user: str | None, estimated_tokens: int, used_tokens: int):
+        """Replaces the estimated tokens of a finished request with the used ones"""
+        now = time.monotonic()
+        for bucket_id in self._bucket_ids(api_key, user):
+            if bucket_id[1] == "tokens":
+                bucket = self._bucket(bucket_id, now)
+                bucket.wait_time(0, now)  # refill before the level changes
+                bucket.take(used_tokens - estimated_tokens)
+
+    def _sweep(self, now: float):
+        """Drops full buckets of idle callers, a new bucket starts full anyway"""
+        if now - self._swept_at < config.RATE_LIMIT_SWEEP_SECONDS:
+            return
+        self._swept_at = now
+        for bucket_id in [i for i, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[bucket_id]
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), **self.metrics}
+
+
+limiter = RateLimiter()
@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import time
+
+import config
+import events
+
+
+def cache_key(model: str, messages: list, params: dict | None = None) -> str:
+    """Canonical hash of a request, equal requests get equal keys regardless of JSON formatting"""
+    canonical = json.dumps(
+        {
+            "model": model,
+            "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+            "params": params or {},
+            "protocol": events.PROTOCOL_VERSION,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _size_of(chunks: list) -> int:
+    return sum(len(chunk.text.encode("utf-8")) for chunk in chunks)
+
+
+class ResponseCache:
+    """
+    Two-tier cache of complete streamed responses: in-memory LRU and a directory of JSON files.
+    Both tiers have a TTL and a size limit, memory misses are looked up on disk.
+    """
+
+    def __init__(self,
+                 max_items: int = config.RESPONSE_CACHE_MAX_ITEMS,
+                 max_bytes: int = config.RESPONSE_CACHE_MAX_BYTES,
+                 ttl: float = config.RESPONSE_CACHE_TTL_SECONDS,
+                 disk_dir: str | None = config.RESPONSE_CACHE_DIR,
+                 disk_max_bytes: int = config.RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries: collections.OrderedDict[str, tuple[list, float, int]] = collections.OrderedDict()
+        self.size = 0
+        self.metrics = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+
+    async def get(self, key: str) -> list | None:
+        """Chunks of the cached response or None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            chunks, created_at, _ = entry
+            if time.time() - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self.metrics["memory_hits"] += 1
+                return chunks
+            self._remove(key)
+
+        if self.disk_dir:
+            stored = await asyncio.to_thread(self._read_file, key)
+            if stored is not None:
+                chunks, created_at = stored
+                self._put_memory(key, chunks, created_at)
+                self.metrics["disk_hits"] += 1
+                return chunks
+
+        self.metrics["misses"] += 1
+        return None
+
+    async def put(self, key: str, chunks: list):
+        created_at = time.time()
+        self._put_memory(key, chunks, created_at)
+        self.metrics["stores"] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_file, key, chunks, created_at)
+
+    def _put_memory(self, key: str, chunks: list, created_at: float):
+        self._remove(key)
+        size = _size_of(chunks)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (chunks, created_at, size)
+        self.size += size
+        while len(self._entries) > self.max_items or self.size > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+            self.metrics["evictions"] += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_file(self, key: str) -> tuple[list, float] | None:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - stored["created_at"] > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return [events.Delta(*chunk) for chunk in stored["chunks"]], stored["created_at"]
+
+    def _write_file(self, key: str, chunks: list, created_at: float):
+        os.makedirs(self.disk_dir, exist_ok=True)
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created_at": created_at, "chunks": chunks}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(key))
+        self._trim_disk()
+
+    def _trim_disk(self):
+        """Removes expired files and then the oldest ones until the directory fits in `disk_max_bytes`"""
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        now = time.time()
+        for mtime, size, path in files:
+            if total <= self.disk_max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {"items": len(self._entries), "bytes": self.size, **self.metrics}
+
+
+cache = ResponseCache()
+
+
+async def record(key: str, chunks):
+    """Passes `chunks` through and caches them if the stream finishes normally"""
+    recorded = []
+    async for chunk in chunks:
+        recorded.append(chunk)
+        yield chunk
+    if recorded:
+        await cache.put(key, recorded)
+
+
+async def replay(chunks: list,
+                 chars_per_second: float = config.RESPONSE_CACHE_REPLAY_CHARS_PER_SECOND,
+                 max_delay: float = config.RESPONSE_CACHE_REPLAY_MAX_DELAY_SECONDS):
+    """Streams cached chunks with pauses proportional to their length, like a live generation"""
+    for i, chunk in enumerate(chunks):
+        if i and chars_per_second > 0:
+            await asyncio.sleep(min(len(chunk.text) / chars_per_second, max_delay))
+        yield chunk
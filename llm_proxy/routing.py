@@ -0,0 +1,174 @@
+import collections
+import time
+
+import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class DeploymentHealth:
+    """EWMA latency, throughput and error statistics of one deployment plus its circuit breaker"""
+
+    def __init__(self, deployment_id: str):
+        self.deployment_id = deployment_id
+        self.ttft = None  # EWMA of time to first token, seconds
+        self.ttft_samples = collections.deque(maxlen=config.ROUTING_TTFT_SAMPLES)  # for percentiles
+        self.throughput = None  # EWMA of chars per second after the first token
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.last_error = None
+
+    def expected_latency(self) -> float:
+        """Expected time of a typical answer, untried deployments get 0 so they are tried first"""
+        if not self.requests:
+            return 0.0
+        latency = self.ttft if self.ttft is not None else config.ROUTING_DEFAULT_TTFT_SECONDS
+        if self.throughput:
+            latency += config.ROUTING_TYPICAL_ANSWER_CHARS / self.throughput
+        return latency * (1 + config.ROUTING_ERROR_PENALTY * self.error_rate)
+
+    def as_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "ttft_ms": round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            "throughput_chars_per_s": round(self.throughput, 1) if self.throughput is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "expected_latency_ms": round(self.expected_latency() * 1000, 1),
+            "last_error": self.last_error,
+        }
+
+
+def _ewma(old: float | None, value: float) -> float:
+    return value if old is None else (1 - config.ROUTING_EWMA_ALPHA) * old + config.ROUTING_EWMA_ALPHA * value
+
+
+class HealthTracker:
+    """
+    Keeps `DeploymentHealth` of every deployment and picks the fastest healthy one.
+    A deployment with `CIRCUIT_FAILURE_THRESHOLD` failures in a row is ejected for
+    `CIRCUIT_OPEN_SECONDS`, then a single probe request decides whether it comes back.
+    """
+
+    def __init__(self):
+        self._health: dict[str, DeploymentHealth] = {}
+        self.decisions = collections.deque(maxlen=config.ROUTING_DECISIONS_KEPT)
+
+    def get(self, deployment_id: str) -> DeploymentHealth:
+        health = self._health.get(deployment_id)
+        if health is None:
+            health = self._health[deployment_id] = DeploymentHealth(deployment_id)
+        return health
+
+    def is_available(self, deployment_id: str, now: float | None = None) -> bool:
+        health = self.get(deployment_id)
+        if health.state == CLOSED:
+            return True
+        now = time.monotonic() if now is None else now
+        if health.state == OPEN and now - health.opened_at >= config.CIRCUIT_OPEN_SECONDS:
+            health.state = HALF_OPEN
+        return health.state == HALF_OPEN and not health.probe_in_flight
+
+    def choose(self, model_name: str, deployment_ids: list) -> str | None:
+        """The available deployment with the lowest expected latency, `deployment_ids` are in round robin order"""
+        now = time.monotonic()
+        candidates = [i for i in deployment_ids if self.is_available(i, now)]
+        if not candidates:
+            return None
+        # Ejected deployments waiting for a probe go first, otherwise they never come back
+        probes = [i for i in candidates if self.get(i).state == HALF_OPEN]
+        # min() keeps the first of equal ones, so the round robin order breaks ties
+        chosen = probes[0] if probes else min(candidates, key=lambda i: self.get(i).expected_latency())
+        health = self.get(chosen)
+        if health.state == HALF_OPEN:
+            health.probe_in_flight = True
+        self.decisions.append({
+            "at": round(time.time(), 3),
+            "model": model_name,
+            "chosen": chosen,
+            "state": health.state,
+            "candidates": {i: round(self.get(i).expected_latency() * 1000, 1) for i in candidates},
+        })
+        return chosen
+
+    def record_first_token(self, deployment_id: str, ttft: float):
+        health = self.get(deployment_id)
+        health.ttft = _ewma(health.ttft, ttft)
+        health.ttft_samples.append(ttft)
+
+    def ttft_percentile(self, deployment_ids: list, percentile: float, min_samples: int = 1) -> float | None:
+        """Percentile (0..1) of recent times to first token of the deployments, None without enough samples"""
+        samples = sorted(t for i in deployment_ids for t in self.get(i).ttft_samples)
+        if len(samples) < min_samples or not samples:
+            return None
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+    def record_success(self, deployment_id: str, chars: int, streaming_time: float):
+        health = self.get(deployment_id)
+        health.requests += 1
+        health.consecutive_failures = 0
+        health.error_rate = _ewma(health.error_rate, 0.0)
+        # Short answers are dominated by timer noise
+        if chars >= config.ROUTING_MIN_THROUGHPUT_CHARS and streaming_time > 0:
+            health.throughput = _ewma(health.throughput, chars / streaming_time)
+        health.state = CLOSED
+        health.probe_in_flight = False
+
+    def record_failure(self, deployment_id: str, error: BaseException):
+        health = self.get(deployment_id)
+        health.requests += 1
+        health.failures += 1
+        health.consecutive_failures += 1
+        health.error_rate = _ewma(health.error_rate, 1.0)
+        health.last_error = f"{type(error).__name__}: {str(error)[:200]}"
+        health.probe_in_flight = False
+        if health.state == HALF_OPEN or health.consecutive_failures >= config.CIRCUIT_FAILURE_THRESHOLD:
+            health.state = OPEN
+            health.opened_at = time.monotonic()
+            print(f"Circuit of {deployment_id} opened: {health.last_error}")
+
+    def record_abandoned(self, deployment_id: str):
+        """Client left before the end, the request tells nothing about the deployment"""
+        self.get(deployment_id).probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "deployments": {i: health.as_dict() for i, health in sorted(self._health.items())},
+            "recent_decisions": list(self.decisions),
+        }
+
+
+tracker = HealthTracker()
+
+
+async def observe(deployment_id: str, chunks):
+    """Passes `chunks` through and records time to first token, throughput and the outcome"""
+    started_at = time.monotonic()
+    first_token_at = None
+    chars = 0
+    finished = False
+    try:
+        async for chunk in chunks:
+            if first_token_at is None:
+                first_token_at = time.monotonic()
+                tracker.record_first_token(deployment_id, first_token_at - started_at)
+            chars += len(chunk.text)
+            yield chunk
+        finished = True
+    except Exception as error:
+        tracker.record_failure(deployment_id, error)
+        raise
+    finally:
+        if finished:
+            tracker.record_success(deployment_id, chars, time.monotonic() - (first_token_at or started_at))
+        elif tracker.get(deployment_id).probe_in_flight:
+            tracker.record_abandoned(deployment_id)
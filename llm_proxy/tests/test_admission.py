@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # load_data reads providers.yaml
+
+import admission
+import config
+import routing
+
+
+def deployment(deployment_id: str) -> dict:
+    return {"model_name": "m", "litellm_params": {"model": "github/m", "api_key": "k"},
+            "model_info": {"id": deployment_id, "rpm": None, "tpm": None}}
+
+
+def test_discarded_probe_lease_keeps_deployment_available():
+    controller = admission.AdmissionController([deployment("m/discarded-probe")], queue_timeout=0.1)
+    health = routing.tracker.get("m/discarded-probe")
+    health.state = routing.OPEN
+    health.opened_at = -config.CIRCUIT_OPEN_SECONDS
+
+    async def run():
+        lease = await controller.acquire("m")
+        assert health.state == routing.HALF_OPEN and health.probe_in_flight
+        controller.release(lease, 0)  # e.g. an identical generation turned up meanwhile
+        return await controller.acquire("m")
+
+    assert asyncio.run(run()).deployment_id == "m/discarded-probe"
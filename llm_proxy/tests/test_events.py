@@ -0,0 +1,50 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import events
+
+
+def split(texts: list) -> list:
+    async def deltas():
+        for text in texts:
+            yield events.Delta(events.CONTENT, text)
+
+    async def collect():
+        return [delta async for delta in events.split_think_tags(deltas())]
+
+    return asyncio.run(collect())
+
+
+def merged(deltas: list) -> list:
+    """Consecutive deltas of one kind joined, so the test doesn't depend on how the text is cut"""
+    result = []
+    for delta in deltas:
+        if result and result[-1][0] == delta.kind:
+            result[-1] = (delta.kind, result[-1][1] + delta.text)
+        else:
+            result.append((delta.kind, delta.text))
+    return result
+
+
+def test_think_block_over_several_deltas():
+    assert merged(split(["<think>hel", "lo", " world</think>answer"])) == [
+        (events.REASONING, "hello world"),
+        (events.CONTENT, "answer"),
+    ]
+
+
+def test_tags_split_between_deltas():
+    assert merged(split(["<th", "ink>reason", "ing</thi", "nk>The ", "answer <b>"])) == [
+        (events.REASONING, "reasoning"),
+        (events.CONTENT, "The answer <b>"),
+    ]
+
+
+def test_content_without_tags_passes_through():
+    assert split(["Hello", " world"]) == [
+        events.Delta(events.CONTENT, "Hello"),
+        events.Delta(events.CONTENT, " world"),
+    ]
@@ -1,26 +1,54 @@
 import os
+import asyncio
+import functools
+import hmac
+import json
 import litellm
-from flask import abort
+from quart import abort
 
-from load_data import model_list, fallbacks, unique_model_names
+import config
+import events
+from load_data import res_model_list, fallbacks, unique_model_names
 
 router = litellm.Router(
-    model_list=model_list,
+    model_list=res_model_list,
     fallbacks=fallbacks,
     num_retries=3,
     timeout=10
 )
 
 
+@functools.cache
+def access_api_keys() -> tuple[str, ...]:
+    """
+    Keys of the callers: ACCESS_API_KEY holds one key or a JSON list of keys.
+    Read once, on the first request, when .env is already loaded.
+    """
+    value = os.getenv("ACCESS_API_KEY", "").strip()
+    if value.startswith("["):
+        return tuple(str(key) for key in json.loads(value) if key)
+    return (value,) if value else ()
+
+
 def check_api_key(api_key: str) -> bool:
     """
     Check if the API key is valid.
     """
-    if not api_key or api_key != os.getenv("ACCESS_API_KEY"):
-        print(api_key, os.getenv("ACCESS_API_KEY"), type(api_key), type(os.getenv("ACCESS_API_KEY")))
+    # Constant-time comparison, and the keys are never printed
+    if not isinstance(api_key, str) or not any(hmac.compare_digest(api_key.encode(), key.encode())
+                                               for key in access_api_keys()):
         abort(401, "Invalid API key")
+    return True
     
 
+def bearer_api_key(request) -> str | None:
+    """
+    API key of an OpenAI-compatible request from the `Authorization: Bearer <key>` header.
+    """
+    scheme, _, api_key = request.headers.get("Authorization", "").partition(" ")
+    return api_key.strip() if scheme.lower() == "bearer" else None
+
+
 def valid_model_request(request: dict) -> bool:
     """
     Check if the request is valid.
@@ -39,9 +67,70 @@ def valid_model_request(request: dict) -> bool:
     for message in request["messages"]:
         if "role" not in message or message["role"] not in ["system", "user", "assistant"] or "content" not in message:
             abort(400, "Each message must contain a role (one of ['system', 'user', 'assistant']) and content")
+    if "user" in request and not isinstance(request["user"], (str, int)):
+        abort(400, "User should be a string or an integer")
+    if request.get("tier", config.DEFAULT_TIER) not in config.TIER_WEIGHTS:
+        abort(400, f"Tier should be one of {list(config.TIER_WEIGHTS)}")
+    if not isinstance(request.get("cache", False), bool):
+        abort(400, "Cache should be a boolean")
     return True
 
 
+def generation_params(request: dict) -> dict:
+    """
+    Sampling parameters of a request that are forwarded to the provider, invalid values abort with 400.
+    """
+    params = {name: request[name] for name in config.GENERATION_PARAMS if request.get(name) is not None}
+    for name, value in params.items():
+        if name == "stop":
+            valid = isinstance(value, str) or (isinstance(value, list) and all(isinstance(s, str) for s in value))
+        elif name in ("max_tokens", "seed"):
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if not valid:
+            abort(400, f"Invalid {name}")
+    return params
+
+
+def request_identity(request: dict) -> tuple[str, str]:
+    """
+    User and tier of a valid request for fair-share scheduling.
+    Requests without a user share one "anonymous" queue.
+    """
+    return str(request.get("user", "anonymous")), request.get("tier", config.DEFAULT_TIER)
+
+
+def request_cost(messages: list) -> int:
+    """
+    Rough cost of a request in tokens: prompt size plus the expected answer.
+    """
+    return sum(len(str(message["content"])) for message in messages) // 4 + config.REQUEST_BASE_COST_TOKENS
+
+
+def _tokenizer_model(model: str) -> str:
+    """litellm model of the first deployment, its tokenizer is used for token counts"""
+    return next((d["litellm_params"]["model"] for d in res_model_list if d["model_name"] == model), model)
+
+
+def _count_tokens(model: str, messages: list, completion: str) -> tuple[int, int]:
+    tokenizer_model = _tokenizer_model(model)
+    prompt_tokens = litellm.token_counter(model=tokenizer_model, messages=messages)
+    completion_tokens = litellm.token_counter(model=tokenizer_model, text=completion) if completion else 0
+    return prompt_tokens, completion_tokens
+
+
+async def count_usage(model: str, messages: list, completion: str) -> dict:
+    """
+    Prompt and completion tokens of a generation counted with the model's tokenizer.
+    Counted by the proxy, so cached and shared generations are counted the same way.
+    """
+    # Long contexts and answers take milliseconds to tokenize, that would stall other streams
+    prompt_tokens, completion_tokens = await asyncio.to_thread(_count_tokens, model, messages, completion)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
 # def generate(model: str="github/ministral-3B", messages: list=[]):
 #     response = router.completion(
 #         model=model, 
@@ -55,51 +144,128 @@ def valid_model_request(request: dict) -> bool:
 #             yield content
 
 
-def generate(model: str="github/ministral-3B", messages: list=[]):
+async def _deltas(model: str, response):
+    separator = config.REASONING_SEPARATORS.get(model)
+    in_reasoning = separator is not None  # such models start with reasoning and mark its end in the content
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        reasoning = getattr(delta, "reasoning_content", None) or getattr(delta, "reasoning", None)
+        if reasoning:
+            yield events.Delta(events.REASONING, reasoning)
+        content = delta.content
+        if content:
+            if in_reasoning and separator in content:
+                in_reasoning = False
+            yield events.Delta(events.REASONING if in_reasoning else events.CONTENT, content)
+
+
+async def generate(model: str="github/ministral-3B", messages: list=[], deployment_id: str | None = None,
+                   params: dict | None = None):
     """
-    Generate a response from the model.
+    Generate a response from the model as `events.Delta`s of reasoning and content.
+    Async generator, so a stream holds no thread while it waits for the provider.
+    `deployment_id` pins the request to the deployment leased by the admission layer,
+    `params` are the sampling parameters from `generation_params`.
     """
-    response = router.completion(
-        model=model, 
+    response = await router.acompletion(
+        model=deployment_id or model, 
         messages=messages,
-        stream=True
+        stream=True,
+        # A deployment that lacks a parameter (e.g. seed) still serves the request
+        drop_params=True,
+        **(params or {})
     )
-    first_chunk = True
-    reasoning = False
-
-    if model == "phi-4-reasoning":
-        last_chunk = False
-        reasoning = True
-        yield "<reasoning>\n"
-        for chunk in response:
-
-            delta = chunk.choices[0].delta
-            content = delta.content
-
-            if content:
-                if reasoning and "───" in content:
-                    reasoning = False
-                    yield "</reasoning>\n\n"
-                yield content
-            
-    else:
-        for chunk in response:
-
-            delta = chunk.choices[0].delta
-            if first_chunk:
-                first_chunk = False
-                if "reasoning" in delta:
-                    reasoning = True
-                    yield "<reasoning>"
-
-            if reasoning:
-                if delta.reasoning is not None:
-                    yield delta.reasoning
-                    # continue
+    deltas = events.split_think_tags(_deltas(model, response))
+    try:
+        async for delta in deltas:
+            yield delta
+    finally:
+        # Closing the provider stream at once frees the provider connection when the client left
+        await deltas.aclose()
+        if hasattr(response, "aclose"):
+            await response.aclose()
+
+
+class SharedGeneration:
+    """
+    One upstream stream shared by identical requests (single-flight).
+    A background task reads the upstream into a buffer, every subscriber replays the buffer
+    and then follows new chunks. The upstream is cancelled when the last subscriber leaves.
+    """
+
+    def __init__(self, key: str, chunks):
+        self.key = key
+        self.buffer = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(self._run(chunks))
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def _run(self, chunks):
+        try:
+            async for chunk in chunks:
+                self.buffer.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("Generation was cancelled")
+        except Exception as error:
+            self.error = error
+        finally:
+            self.done = True
+            self._unregister()
+            self._notify()
+            await chunks.aclose()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(self.buffer):
+                    position += 1
+                    yield self.buffer[position - 1]
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
                 else:
-                    yield "</reasoning>"
-                    reasoning = False
+                    await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # At once, not when the task handles the cancel: a request joining meanwhile would get the abort
+                self._unregister()
+                self._task.cancel()
+
+    def _unregister(self):
+        if shared_generations.get(self.key) is self:
+            del shared_generations[self.key]
+
+
+shared_generations: dict[str, SharedGeneration] = {}  # in-flight generations by request key
+
 
-            content = delta.content
-            if content:
-                yield content
\ No newline at end of file
+def join_generation(key: str):
+    """
+    Subscription to the in-flight generation of an identical request or None.
+    """
+    generation = shared_generations.get(key)
+    if generation is None or generation.done:
+        return None
+    return generation.subscribe()
+
+
+def share_generation(key: str, chunks):
+    """
+    Starts `chunks` as a shared generation and returns the first subscription to it.
+    """
+    generation = SharedGeneration(key, chunks)
+    shared_generations[key] = generation
+    return generation.subscribe()
\ No newline at end of file
@@ -1,12 +1,18 @@
 import os
 import asyncio
 import aiogram
+import aiohttp
 import dotenv
 import logging
 
 import routers
 import middleware
 import settings
+import services.edit_scheduler
+import services.message_service
+import services.model_catalog
+import services.persistence_worker
+import services.usage_service
 
 from models import db_session
 
@@ -14,10 +20,58 @@ dotenv.load_dotenv()
 
 bot = aiogram.Bot(token=os.getenv("BOT_TOKEN"))
 dp = aiogram.Dispatcher()
-dp.update.outer_middleware(middleware.db.DbSessionMiddleware())
+db_middleware = middleware.db.AsyncDbSessionMiddleware() if settings.DB_ASYNC else middleware.db.DbSessionMiddleware()
+dp.message.middleware(db_middleware)
+dp.callback_query.middleware(db_middleware)
+dp.shutdown.register(services.edit_scheduler.scheduler.close)
+
+
+def create_ai_http_session() -> aiohttp.ClientSession:
+    """Creates the shared HTTP client for requests to the LLM proxy"""
+    connector = aiohttp.TCPConnector(
+        limit=settings.AI_HTTP_POOL_SIZE,
+        limit_per_host=settings.AI_HTTP_POOL_SIZE_PER_HOST,
+        keepalive_timeout=settings.AI_HTTP_KEEPALIVE_SEC,
+        ttl_dns_cache=settings.AI_HTTP_DNS_CACHE_SEC
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=None,  # streams can be long, only connection and gaps between chunks are limited
+        connect=settings.AI_HTTP_CONNECT_TIMEOUT_SEC,
+        sock_read=settings.AI_HTTP_READ_TIMEOUT_SEC
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@dp.startup()
+async def on_startup(dispatcher: aiogram.Dispatcher):
+    dispatcher["http_session"] = create_ai_http_session()
+    services.persistence_worker.worker.start()
+    await services.usage_service.counters.load()
+    dispatcher["model_catalog_task"] = asyncio.create_task(
+        services.model_catalog.run_refresh_job(dispatcher["http_session"]))
+    if settings.PURGE_CLEARED_MESSAGES:
+        dispatcher["purge_task"] = asyncio.create_task(services.message_service.run_purge_job())
+
+
+@dp.shutdown()
+async def on_shutdown(dispatcher: aiogram.Dispatcher):
+    for task_name in ("purge_task", "model_catalog_task"):
+        task: asyncio.Task | None = dispatcher.workflow_data.pop(task_name, None)
+        if task:
+            task.cancel()
+    http_session: aiohttp.ClientSession | None = dispatcher.workflow_data.pop("http_session", None)
+    if http_session:
+        await http_session.close()
+    await services.persistence_worker.worker.stop()
+    if settings.DB_ASYNC:
+        await db_session.dispose_async()
+
 
 async def main():
-    db_session.global_init(settings.DB_FILE)
+    if settings.DB_ASYNC:
+        await db_session.global_init_async(settings.DB_FILE)
+    else:
+        db_session.global_init(settings.DB_FILE)
     dp.include_routers(*routers.routers)
     os.makedirs("profile_images", exist_ok=True)
     await dp.start_polling(bot)
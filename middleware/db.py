@@ -1,6 +1,8 @@
 from typing import Callable, Dict, Any, Awaitable, Optional
 
 import aiogram
+import aiogram.dispatcher.flags
+from aiogram.dispatcher.event.handler import HandlerObject
 import sqlalchemy.exc
 
 import models.db_session
@@ -8,12 +10,47 @@ import services.user_service
 import models
 
 
+def wants_db_session(data: Dict[str, Any]) -> bool:
+    """Session is opened only for handlers that take `session` or `user` arguments.
+
+    Handlers can also opt out explicitly with `flags={"db_session": False}`.
+    """
+    if not aiogram.dispatcher.flags.get_flag(data, "db_session", default=True):
+        return False
+    handler: Optional[HandlerObject] = data.get("handler")
+    if handler is None or handler.varkw:
+        return True
+    return "session" in handler.params or "user" in handler.params
+
+
+async def handle_without_session(handler: Callable[[aiogram.types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                                 event: aiogram.types.TelegramObject,
+                                 data: Dict[str, Any]):
+    """Passes cached `user_settings` to handlers that ask for them, the DB is used only on a cache miss"""
+    handler_object: Optional[HandlerObject] = data.get("handler")
+    telegram_user: Optional[aiogram.types.User] = data.get("event_from_user", None)
+    if telegram_user and handler_object is not None and "user_settings" in handler_object.params:
+        try:
+            data["user_settings"] = await services.user_service.get_user_settings(telegram_user)
+        except sqlalchemy.exc.SQLAlchemyError as error:
+            print(f"Database error fetching/creating user {telegram_user.id}: {error}")
+            return
+    return await handler(event, data)
+
+
 class DbSessionMiddleware(aiogram.BaseMiddleware):
+    """Opens a session and loads `user` for each handler call, commits after the handler returns.
+
+    Must be registered as an inner middleware, handler flags are not known in outer ones.
+    """
 
     async def __call__(self,
                        handler: Callable[[aiogram.types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
                        event: aiogram.types.TelegramObject,
                        data: Dict[str, Any]):
+        if not wants_db_session(data):
+            return await handle_without_session(handler, event, data)
+
         session = models.db_session.get_session()
         data["session"] = session
 
@@ -40,4 +77,40 @@ class DbSessionMiddleware(aiogram.BaseMiddleware):
             session.rollback()  # TODO: add error logging
             raise
         finally:
-            session.close()
\ No newline at end of file
+            session.close()
+
+
+class AsyncDbSessionMiddleware(aiogram.BaseMiddleware):
+    """Same as `DbSessionMiddleware`, but hands out `AsyncSession`, so queries don't block the event loop"""
+
+    async def __call__(self,
+                       handler: Callable[[aiogram.types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: aiogram.types.TelegramObject,
+                       data: Dict[str, Any]):
+        if not wants_db_session(data):
+            return await handle_without_session(handler, event, data)
+
+        async with models.db_session.get_async_session() as session:
+            data["session"] = session
+
+            telegram_user: Optional[aiogram.types.User] = data.get("event_from_user", None)
+            if telegram_user:
+                try:
+                    user = await services.user_service.get_or_create_user_async(session=session,
+                                                                                telegram_user=telegram_user)
+                    data["user"] = user
+                except sqlalchemy.exc.SQLAlchemyError as error:
+                    print(f"Database error fetching/creating user {telegram_user.id}: {error}")
+                    await session.rollback()
+                    return
+                except ValueError as ve:
+                    print(f"Could not create user {telegram_user.id}: {ve}")
+
+            try:
+                result = await handler(event, data)
+                await session.commit()
+                return result
+            except Exception:
+                print(f"Error in handler for user {telegram_user.id if telegram_user else None}")
+                await session.rollback()
+                raise
@@ -1,5 +1,9 @@
+import contextlib
+import typing
+
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
+import sqlalchemy.ext.asyncio as sa_async
 import logging
 
 import settings
@@ -7,6 +11,8 @@ import settings
 SqlAlchemyBase = sa.orm.declarative_base()
 
 __factory = None
+__async_engine: sa_async.AsyncEngine | None = None
+__async_factory: sa_async.async_sessionmaker | None = None
 
 
 def global_init(db_file):
@@ -25,8 +31,104 @@ def global_init(db_file):
     __factory = orm.sessionmaker(bind=engine)
 
     SqlAlchemyBase.metadata.create_all(engine)
+    with engine.begin() as conn:
+        upgrade_schema(conn)
+
+
+def upgrade_schema(connection: sa.Connection):
+    """Adds columns and indexes that appeared in models after the tables were created.
+
+    `create_all` skips existing tables and there are no migrations, so new columns must be nullable
+    or have a `server_default`.
+    """
+    inspector = sa.inspect(connection)
+    for table in SqlAlchemyBase.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            logging.info(f"Upgrading schema: {ddl}")
+            connection.execute(sa.text(ddl))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
 
 def get_session() -> sa.orm.Session:
     global __factory
-    return __factory()
\ No newline at end of file
+    return __factory()
+
+
+async def global_init_async(db_file):
+    """Creates async engine over aiosqlite, used instead of `global_init` if settings.DB_ASYNC is on"""
+    global __async_engine, __async_factory
+
+    if __async_factory:
+        return
+
+    if not db_file or not db_file.strip():
+        raise FileNotFoundError("DB filename are not specified")
+
+    conn_str = f'sqlite+aiosqlite:///{db_file.strip()}'
+    logging.info(f"Async connection to db at the address {db_file}")
+
+    __async_engine = sa_async.create_async_engine(conn_str)
+    # Objects are used after commit in handlers, lazy refresh is not possible in async mode
+    __async_factory = sa_async.async_sessionmaker(bind=__async_engine, expire_on_commit=False)
+
+    async with __async_engine.begin() as conn:
+        await conn.run_sync(SqlAlchemyBase.metadata.create_all)
+        await conn.run_sync(upgrade_schema)
+
+
+def get_async_session() -> sa_async.AsyncSession:
+    return __async_factory()
+
+
+def is_async_session(session: sa.orm.Session | sa_async.AsyncSession) -> bool:
+    return isinstance(session, sa_async.AsyncSession)
+
+
+async def execute(session: sa.orm.Session | sa_async.AsyncSession, statement, params=None) -> sa.Result:
+    """`session.execute` for both sync and async session"""
+    if is_async_session(session):
+        return await session.execute(statement, params)
+    return session.execute(statement, params)
+
+
+async def dispose_async():
+    global __async_engine, __async_factory
+    if __async_engine:
+        await __async_engine.dispose()
+    __async_engine = None
+    __async_factory = None
+
+
+@contextlib.asynccontextmanager
+async def session_scope() -> typing.AsyncIterator[sa.orm.Session | sa_async.AsyncSession]:
+    """Short transaction outside of the per-update session, commits on exit and rolls back on error.
+
+    Yields `AsyncSession` if the async engine is initialized, otherwise sync `Session`.
+    """
+    if __async_factory:
+        async with __async_factory() as session:
+            try:
+                yield session
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+        return
+
+    session = get_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
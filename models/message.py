@@ -7,11 +7,21 @@ from .db_session import SqlAlchemyBase
 
 class Message(SqlAlchemyBase):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Context is read as the newest messages of a user in the current epoch
+        sa.Index("ix_messages_owner_id_epoch_id", "owner_id", "epoch", "id"),
+    )
 
     id: orm.Mapped[int] = orm.mapped_column(sa.Integer, primary_key=True)
     owner_id: orm.Mapped[int] = orm.mapped_column(sa.Integer, sa.ForeignKey('users.id'))
     is_from_user: orm.Mapped[bool] = orm.mapped_column(sa.Boolean, nullable=False, default=True)
+    epoch: orm.Mapped[int] = orm.mapped_column(sa.Integer, nullable=False, default=0, server_default="0")  # owner's context epoch
 
     content: orm.Mapped[str] = orm.mapped_column(sa.String, nullable=False)
+    token_count: orm.Mapped[int | None] = orm.mapped_column(sa.Integer, nullable=True)  # estimated once on insert
+
+    # Rolling summary of the user's messages with id <= summary_until_id, used in context instead of them
+    is_summary: orm.Mapped[bool] = orm.mapped_column(sa.Boolean, nullable=False, default=False, server_default="0")
+    summary_until_id: orm.Mapped[int | None] = orm.mapped_column(sa.Integer, nullable=True)
 
     owner = orm.relationship("User", back_populates="messages")
\ No newline at end of file
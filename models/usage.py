@@ -0,0 +1,22 @@
+import datetime
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from .db_session import SqlAlchemyBase
+
+
+class Usage(SqlAlchemyBase):
+    """Requests and tokens of a user with one model during one day (UTC), counters are only incremented"""
+    __tablename__ = "usage"
+    __table_args__ = (
+        sa.UniqueConstraint("user_id", "model", "day", name="uq_usage_user_id_model_day"),
+    )
+
+    id: orm.Mapped[int] = orm.mapped_column(sa.Integer, primary_key=True)
+    user_id: orm.Mapped[int] = orm.mapped_column(sa.Integer, sa.ForeignKey('users.id'), nullable=False)
+    model: orm.Mapped[str] = orm.mapped_column(sa.String, nullable=False)
+    day: orm.Mapped[datetime.date] = orm.mapped_column(sa.Date, nullable=False)
+
+    requests: orm.Mapped[int] = orm.mapped_column(sa.Integer, nullable=False, default=0)
+    prompt_tokens: orm.Mapped[int] = orm.mapped_column(sa.Integer, nullable=False, default=0)
+    completion_tokens: orm.Mapped[int] = orm.mapped_column(sa.Integer, nullable=False, default=0)
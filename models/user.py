@@ -26,6 +26,9 @@ class User(SqlAlchemyBase):
 
     profile_media_group_id: orm.Mapped[str] = orm.mapped_column(sa.String, nullable=True)
 
+    # Context contains only messages of the current epoch, clearing context increments it
+    context_epoch: orm.Mapped[int] = orm.mapped_column(sa.Integer, nullable=False, default=0, server_default="0")
+
     referrer = orm.relationship("User", back_populates="referrals", remote_side=[id])
     referrals = orm.relationship("User", back_populates="referrer")
 
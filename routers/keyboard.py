@@ -5,6 +5,7 @@ import aiogram.exceptions
 import aiogram.fsm.state
 import aiogram.fsm.context
 import sqlalchemy.orm as orm
+import sqlalchemy.ext.asyncio as sa_async
 
 from aiogram import Router
 from aiogram import filters
@@ -13,6 +14,8 @@ from aiogram import types
 import keyboards
 import models.user
 import strings
+import services.model_catalog
+import services.user_cache
 import services.user_service
 
 kb_router = Router()
@@ -45,7 +48,7 @@ async def _update_message(message: aiogram.types.Message, new_text: str,
 # @kb_router.callback_query(MenuState.navigating, )
 @kb_router.callback_query(MenuState.navigating, keyboards.callback_data.SettingsCallback.filter())
 async def navigate_settings(query: types.CallbackQuery, callback_data: keyboards.callback_data.SettingsCallback,
-                            state: aiogram.fsm.context.FSMContext, user: models.user.User, session: orm.Session,
+                            state: aiogram.fsm.context.FSMContext, user: models.user.User, session: orm.Session | sa_async.AsyncSession,
                             bot: aiogram.Bot):
     await query.answer()
 
@@ -81,8 +84,8 @@ async def navigate_settings(query: types.CallbackQuery, callback_data: keyboards
                 next_menu_key = history[-1]
                 await state.update_data(prompt_message_id=query.message.message_id, history=history)
                 await state.set_state(MenuState.waiting_for_instructions)
-        session.add(user)
-        session.flush()
+        await services.user_service.save_user(session, user)
+        services.user_cache.invalidate_after_commit(session, user.id)
 
 
     kb = await keyboards.inline.get_settings_keyboard(next_menu_key, user)
@@ -99,7 +102,7 @@ async def navigate_settings(query: types.CallbackQuery, callback_data: keyboards
 
 
 @kb_router.message(MenuState.waiting_for_instructions)
-async def set_instructions(message: aiogram.types.Message, session: orm.Session, state: aiogram.fsm.context.FSMContext,
+async def set_instructions(message: aiogram.types.Message, session: orm.Session | sa_async.AsyncSession, state: aiogram.fsm.context.FSMContext,
                            user: models.user.User, bot: aiogram.Bot):
     await services.user_service.set_instruction(message.text, session, user)
 
@@ -145,7 +148,7 @@ async def set_instructions(message: aiogram.types.Message, session: orm.Session,
 async def navigate_settings_in_other_state(query: types.CallbackQuery,
                                            callback_data: keyboards.callback_data.SettingsCallback,
                                            state: aiogram.fsm.context.FSMContext, user: models.user.User,
-                                           session: orm.Session, bot: aiogram.Bot):
+                                           session: orm.Session | sa_async.AsyncSession, bot: aiogram.Bot):
     await navigate_settings(query, callback_data, state, user, session, bot)
     await state.set_state(MenuState.navigating)
 
@@ -153,15 +156,15 @@ async def navigate_settings_in_other_state(query: types.CallbackQuery,
 @kb_router.callback_query(keyboards.callback_data.ModelCallback.filter())
 async def change_model(query: aiogram.types.CallbackQuery,
                        callback_data: keyboards.callback_data.ModelCallback,
-                       session: orm.Session,
+                       session: orm.Session | sa_async.AsyncSession,
                        user: models.user.User,
                        bot: aiogram.Bot):
     await query.answer()
     model = callback_data.model
-    if model in strings.MODELS and user.selected_model != model:
+    if model in services.model_catalog.catalog.models and user.selected_model != model:
         user.selected_model = model
-        session.add(user)
-        session.flush()
+        await services.user_service.save_user(session, user)
+        services.user_cache.invalidate_after_commit(session, user.id)
 
     kb = await keyboards.inline.get_model_keyboard(user)
 
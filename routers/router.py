@@ -10,12 +10,24 @@ import aiogram.utils.formatting
 import aiogram.utils.markdown
 import aiohttp
 import sqlalchemy.orm
+import sqlalchemy.ext.asyncio
 from aiogram.exceptions import TelegramBadRequest
 
 import keyboards
+import settings
 import strings
+import models.db_session
 import models.user
+import services.ai_service
+import services.edit_scheduler
 import services.message_service
+import services.persistence_worker
+import services.stream_control
+import services.stream_parser
+import services.tokens
+import services.usage_service
+import services.user_cache
+import services.user_service
 
 # import models.user
 
@@ -31,9 +43,6 @@ router = Router()
 MAX_MESSAGE_LEN = 4096
 # Buffer to avoid hitting the exact limit
 SAFE_MAX_LEN = 4000
-MIN_UPDATE_INTERVAL_SEC = 1.1  # Min interval between message edits to avoid "Too Many Requests"
-THINK_TAG_START = {"<think>", "<reasoning>"}
-THINK_TAG_END = {"</think>", "</reasoning>"}
 
 _recently_processed_media_groups = {}
 _processing_lock = asyncio.Lock()
@@ -61,24 +70,31 @@ async def _update_message_helper(bot: aiogram.Bot,
                                  message_to_edit: types.Message,
                                  new_text: str,
                                  new_markup: types.InlineKeyboardMarkup | None = None,
-                                 parse_mode: str = "HTML"):
-    """Helper to edit a message, similar to _update_message."""
+                                 parse_mode: str = "HTML",
+                                 wait: bool = True):
+    """Helper to edit a message through the edit scheduler, similar to _update_message.
+
+    If `wait` is False, the edit is only queued and `message_to_edit` is returned at once.
+    """
     if not message_to_edit:
         return None
     if message_to_edit.text == new_text and message_to_edit.reply_markup == new_markup:
         return message_to_edit
-    try:
-        return await bot.edit_message_text(
-            text=new_text,
-            chat_id=message_to_edit.chat.id,
-            message_id=message_to_edit.message_id,
-            reply_markup=new_markup,
-            parse_mode=parse_mode
-        )
-    except aiogram.exceptions.TelegramBadRequest as e:
-        if "message is not modified" in str(e).lower():
-            return message_to_edit
-        raise
+    result = services.edit_scheduler.scheduler.submit(
+        bot=bot,
+        chat_id=message_to_edit.chat.id,
+        message_id=message_to_edit.message_id,
+        text=new_text,
+        parse_mode=parse_mode,
+        reply_markup=new_markup,
+        wait=wait
+    )
+    if not wait:
+        return message_to_edit
+    # Shielded: the future is shared with other waiters of the same message, see stop_stream
+    updated_message = await asyncio.shield(result)
+    # None means "message is not modified"
+    return updated_message if isinstance(updated_message, types.Message) else message_to_edit
 
 
 async def send_or_update_formatted_message(bot: aiogram.Bot,
@@ -86,10 +102,15 @@ async def send_or_update_formatted_message(bot: aiogram.Bot,
                                            text_content: str,
                                            current_message_obj: types.Message | None,
                                            is_think_block_content: bool,
-                                           is_last_update: bool = False) -> types.Message | None:
+                                           is_last_update: bool = False,
+                                           wait: bool = True,
+                                           reply_markup: types.InlineKeyboardMarkup | None = None
+                                           ) -> types.Message | None:
     """
     Formats text (e.g., as expandable blockquote if needed) and sends/updates.
     Returns the sent/updated message object or None if sending failed.
+    Intermediate stream updates pass `wait=False`, so the edit is only queued in the edit scheduler,
+    and the Stop button as `reply_markup`, updates without it remove the button.
     """
     if not text_content.strip() and not (current_message_obj and current_message_obj.text == "⏳"):
         if current_message_obj:
@@ -113,8 +134,10 @@ async def send_or_update_formatted_message(bot: aiogram.Bot,
     if current_message_obj:
         try:
             updated_msg = await _update_message_helper(bot=bot, message_to_edit=current_message_obj,
-                                                       new_text=final_text_to_send, new_markup=None,
-                                                       parse_mode=parse_mode)
+                                                       new_text=final_text_to_send, new_markup=reply_markup,
+                                                       parse_mode=parse_mode, wait=wait)
+            if is_last_update:
+                services.edit_scheduler.scheduler.forget(current_message_obj.chat.id, current_message_obj.message_id)
             return updated_msg
         except TelegramBadRequest as e:
             if "message to edit not found" in str(e).lower() or \
@@ -134,8 +157,10 @@ async def send_or_update_formatted_message(bot: aiogram.Bot,
         new_message_sent = True
 
     if new_message_sent:
+        await services.edit_scheduler.scheduler.acquire(chat_id)
         try:
-            return await bot.send_message(chat_id, final_text_to_send, parse_mode=parse_mode)
+            return await bot.send_message(chat_id, final_text_to_send, parse_mode=parse_mode,
+                                          reply_markup=reply_markup)
         except TelegramBadRequest as e:
             logging.info(f"Telegram API error on send: {e}. Formatted Text: '{final_text_to_send[:100]}...'")
             # escaped_text = hide_link(text_content) # Use original raw content for hide_link
@@ -159,7 +184,7 @@ async def send_or_update_formatted_message(bot: aiogram.Bot,
 
 @router.message(filters.CommandStart())
 async def start(message: types.Message,
-                session: sqlalchemy.orm.Session,
+                session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
                 user: models.user.User,
                 command: aiogram.filters.CommandObject):
     if command.args and command.args.isnumeric():
@@ -172,7 +197,7 @@ async def start(message: types.Message,
         reply_markup=keyboards.reply.get_menu_keyboard()
     )
     try:
-        services.message_service.delete_messages(session, user)
+        await services.message_service.delete_messages_async(session, user)
     except Exception:
         pass
 
@@ -181,10 +206,10 @@ async def start(message: types.Message,
 @router.message(aiogram.filters.command.Command("clearcontext"))
 @router.message(aiogram.filters.command.Command("clear"))
 async def clear_context(message: aiogram.types.Message,
-                        session: sqlalchemy.orm.Session,
+                        session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
                         user: models.user.User):
     try:
-        services.message_service.delete_messages(session, user)
+        await services.message_service.delete_messages_async(session, user)
         await message.answer(strings.CLEAR_CONTEXT.SUCESS)
     except Exception:
         await message.answer(strings.CLEAR_CONTEXT.ERROR)
@@ -198,7 +223,9 @@ async def clear_context(message: aiogram.types.Message,
     strings.MENU_KEYBOARD.SETTINGS
 ]))
 async def menu_handler(message: types.Message, state: aiogram.fsm.context.FSMContext,
-                       user: models.user.User, bot: aiogram.Bot):
+                       user_settings: services.user_cache.UserSettings, bot: aiogram.Bot):
+    # Only the profile needs counters from the DB, other menus are built from cached settings
+    user = user_settings
     match message.text:
         case strings.MENU_KEYBOARD.PROFILE:
             file_name = f"profile_images/{user.id}.jpg"
@@ -206,7 +233,11 @@ async def menu_handler(message: types.Message, state: aiogram.fsm.context.FSMCon
                 photo = aiogram.types.FSInputFile(file_name)
                 await message.answer_photo(photo)
 
-            await message.answer(strings.profile_info(user), parse_mode="Markdown")
+            async with models.db_session.session_scope() as session:
+                db_user = await services.user_service.get_or_create_user_async(session, message.from_user)
+                referrals_count = await services.user_service.count_referrals(session, db_user)
+                profile_text = strings.profile_info(db_user, referrals_count)
+            await message.answer(profile_text, parse_mode="Markdown")
 
         case strings.MENU_KEYBOARD.MODEL:
             kb = await keyboards.inline.get_model_keyboard(user)
@@ -238,7 +269,7 @@ async def profile_image(message: aiogram.types.Message,
 @router.message(LoadState.loading_profile_pic, aiogram.F.photo)
 async def load_and_save_profile_image(message: aiogram.types.Message,
                                       user: models.user.User,
-                                      session: sqlalchemy.orm.Session,
+                                      session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
                                       state: aiogram.fsm.context.FSMContext,
                                       bot: aiogram.Bot):
     picture = message.photo[-1]
@@ -318,31 +349,33 @@ async def cancel_profile_image_loading(query: aiogram.types.CallbackQuery,
     await query.message.answer(strings.PROFILE_PHOTO.CANCEL_TEXT)
 
 
-@router.message(aiogram.filters.StateFilter(None), aiogram.F.text)
-@router.message(keyboard.MenuState.navigating, aiogram.F.text)
-async def other_text_handler(message: types.Message,
-                             user: models.user.User,
-                             session: sqlalchemy.orm.Session,
-                             bot: aiogram.Bot):
-    user.requests += 1
-    session.add(user)
+@router.callback_query(keyboards.callback_data.StopStreamCallback.filter(), flags={"db_session": False})
+async def stop_stream(query: aiogram.types.CallbackQuery,
+                      callback_data: keyboards.callback_data.StopStreamCallback):
+    # Cancels the task of `other_text_handler`, which keeps the shown part and saves it
+    if services.stream_control.control.stop(callback_data.stream_id, query.from_user.id):
+        await query.answer(strings.STOP_STREAM.STOPPING)
+    else:
+        await query.answer(strings.STOP_STREAM.FINISHED)
 
-    active_message_object: types.Message | None = None
-    try:
-        active_message_object = await message.answer("⏳")
-    except TelegramBadRequest:
-        await message.answer("Error: Could not start AI response. Try select other model or clear context.")
-        return
 
-    current_text_segment = ""
-    is_in_think_block = False
-    last_update_ts = asyncio.get_event_loop().time()
+@router.message(aiogram.filters.StateFilter(None), aiogram.F.text, flags={"db_session": False})
+@router.message(keyboard.MenuState.navigating, aiogram.F.text, flags={"db_session": False})
+async def other_text_handler(message: types.Message,
+                             bot: aiogram.Bot,
+                             http_session: aiohttp.ClientSession,
+                             user_settings: services.user_cache.UserSettings):
+    # The handler manages its own short transactions, so no DB lock is held while the answer is streamed:
+    # 1. settings and context come from caches, 2. stream without DB access, 3. queue the result for the
+    # persistence worker
+    user = user_settings
+    if services.usage_service.counters.is_over_quota(user.id):  # in-memory counters, no DB read
+        await message.answer(strings.DAILY_QUOTA_REACHED)
+        return
 
     # --- AI Request Setup ---
     # ai_model = "ministral-3b"
     ai_model = user.selected_model or "ministral-3b"
-    api_key = os.getenv("AI_API_KEY", "dac877e7-4afd-4aa4-9c6f-97eedea5810c")
-    stream_url = os.getenv("AI_STREAM_URL", "http://127.0.0.1:5050/stream/")
 
     ai_messages = []
     if user.instruction_mode_on and user.instruction:
@@ -351,150 +384,138 @@ async def other_text_handler(message: types.Message,
         ai_messages.append({"role": "system", "content": strings.DEFAULT_INSTRUCTIONS})
 
     if user.context_mode_on:
-        ai_messages += services.message_service.get_context_messages(session, user)
+        token_budget = services.tokens.get_context_budget(ai_model) - \
+            services.tokens.estimate_tokens(ai_messages[0]["content"]) - \
+            services.tokens.estimate_tokens(message.text)
+        ai_messages += await services.message_service.load_context_messages(user, max(token_budget, 0))
+    await services.persistence_worker.worker.increment(user.id, "requests")
+
+    # The Stop button cancels this task, see `stop_stream`
+    active_stream = services.stream_control.control.register(user.id)
+    stop_markup = await keyboards.inline.get_stop_keyboard(active_stream.id)
+
+    active_message_object: types.Message | None = None
+    try:
+        active_message_object = await message.answer("⏳", reply_markup=stop_markup)
+    except TelegramBadRequest:
+        services.stream_control.control.unregister(active_stream)
+        await message.answer("Error: Could not start AI response. Try select other model or clear context.")
+        return
+
+    stream_url = services.ai_service.get_stream_url()
 
     ai_messages.append({"role": "user", "content": message.text})
-    request_data = {
-        "model": ai_model,
-        "messages": ai_messages,
-        "api_key": api_key
-    }
+    # Without context the request depends only on the question, the proxy may answer it from its cache
+    request_data = services.ai_service.build_request_data(
+        ai_model, ai_messages, user.id, cache=settings.AI_CACHE_ONE_SHOT_REQUESTS and not user.context_mode_on)
     json_request_data = json.dumps(request_data)
     headers = {
         "Content-Type": "application/json"
     }
     # --- End AI Request Setup ---
 
-    processing_buffer = ""  # Accumulates raw text from stream
+    stream_parser = services.stream_parser.StreamParser()
     current_text_segment = ""  # Accumulates raw text for the current logical block (normal or think)
     is_in_think_block = False
-    last_update_ts = asyncio.get_event_loop().time()
-    full_response_for_history = ""
+    response_parts = []  # Content segments for history, reasoning is not stored
+    is_successful = False
 
     try:
-        async with aiohttp.ClientSession() as http_session:
-            async with http_session.post(stream_url, data=json_request_data, headers=headers) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logging.info(f"AI API Error {response.status}: {error_text[:500]}")
-                    active_message_object = await send_or_update_formatted_message(bot, message.chat.id,
-                                                                                   f"AI Error: {response.status}",
-                                                                                   active_message_object, False)
-                    return
-
-                async for chunk_bytes in response.content.iter_any():
-                    if not chunk_bytes:
-                        continue
-                    # print(chunk_bytes.decode("utf-8", errors="ignore"), end="")
-
-                    processing_buffer += chunk_bytes.decode("utf-8", errors="ignore")
-                    full_response_for_history += processing_buffer
-
-                    while True:
-                        chunk_to_process_further = ""
-
-                        if is_in_think_block:
-                            for tag_end in THINK_TAG_END:
-                                end_tag_pos = processing_buffer.find(tag_end)
-                                if end_tag_pos != -1:
-                                    found_tag = tag_end
-                                    break
-                            if end_tag_pos != -1:
-                                segment = processing_buffer[:end_tag_pos]
-                                current_text_segment += segment
-                                processing_buffer = processing_buffer[end_tag_pos + len(found_tag):]
-
-                                if current_text_segment.strip():
-                                    active_message_object = await send_or_update_formatted_message(
-                                        bot, message.chat.id, current_text_segment, active_message_object, True,
-                                        is_last_update=True
-                                    )
-
-                                is_in_think_block = False
-                                current_text_segment = ""
-                                active_message_object = None
-                            else:
-                                current_text_segment += processing_buffer
-                                print(processing_buffer)
-                                processing_buffer = ""
-                                break
-                        else:
-                            for tag_start in THINK_TAG_START:
-                                start_tag_pos = processing_buffer.find(tag_start)
-                                if start_tag_pos != -1:
-                                    found_tag = tag_start
-                                    break
-
-                            if start_tag_pos != -1:
-                                segment = processing_buffer[:start_tag_pos]
-                                current_text_segment += segment
-                                processing_buffer = processing_buffer[start_tag_pos + len(found_tag):]
-
-                                if current_text_segment.strip():
-                                    active_message_object = await send_or_update_formatted_message(
-                                        bot, message.chat.id, current_text_segment, active_message_object, False
-                                    )
-
-                                is_in_think_block = True
-                                current_text_segment = ""
-                            else:
-                                current_text_segment += processing_buffer
-                                print(processing_buffer)
-                                processing_buffer = ""
-                                break
-
-                        if not processing_buffer:
-                            break
-
-                    now = asyncio.get_event_loop().time()
-                    if len(current_text_segment) > SAFE_MAX_LEN or \
-                            (
-                                    current_text_segment.strip() and now - last_update_ts > MIN_UPDATE_INTERVAL_SEC):
-
-                        text_to_format_and_send = current_text_segment
-                        temp_remaining_text = ""
-
-                        is_last_current_message_update = False
-                        if len(current_text_segment) > SAFE_MAX_LEN:
-                            split_at = SAFE_MAX_LEN
-
-                            text_to_format_and_send = current_text_segment[:split_at]
-                            temp_remaining_text = current_text_segment[split_at:]
-                            is_last_current_message_update = True
-
-                        if text_to_format_and_send.strip() or (
-                                active_message_object and active_message_object.text == "⏳"):
+        async with http_session.post(stream_url, data=json_request_data, headers=headers) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logging.info(f"AI API Error {response.status}: {error_text[:500]}")
+                active_message_object = await send_or_update_formatted_message(bot, message.chat.id,
+                                                                               f"AI Error: {response.status}",
+                                                                               active_message_object, False)
+                return
+            services.ai_service.check_stream_protocol(response)
+
+            async for chunk_bytes in response.content.iter_any():
+                if not chunk_bytes:
+                    continue
+
+                for segment in stream_parser.feed(chunk_bytes):
+                    is_in_think_block = segment.kind == services.stream_parser.REASONING
+                    current_text_segment += segment.text
+                    if not is_in_think_block:
+                        response_parts.append(segment.text)
+
+                    if segment.is_block_end:
+                        if current_text_segment.strip():
                             active_message_object = await send_or_update_formatted_message(
-                                bot, message.chat.id, text_to_format_and_send, active_message_object, is_in_think_block,
-                                is_last_update=is_last_current_message_update)
-
-                        if temp_remaining_text.strip():
-                            current_text_segment = temp_remaining_text
-                        if temp_remaining_text.strip():
-                            if active_message_object and text_to_format_and_send.strip():
-                                active_message_object = None
-                        last_update_ts = now
-
-                if processing_buffer:
-                    print(processing_buffer)
-                    current_text_segment += processing_buffer
-                    processing_buffer = ""
-
-                if current_text_segment.strip():
-                    active_message_object = await send_or_update_formatted_message(
-                        bot=bot, chat_id=message.chat.id, text_content=current_text_segment,
-                        current_message_obj=active_message_object, is_think_block_content=is_in_think_block
-                    )
-
-        user.successful_requests += 1
-        session.add(user)
-
-        await asyncio.sleep(10)
-        await send_or_update_formatted_message(
-            bot=bot, chat_id=message.chat.id, text_content=current_text_segment,
-            current_message_obj=active_message_object, is_think_block_content=is_in_think_block
-        )
-
+                                bot, message.chat.id, current_text_segment, active_message_object,
+                                is_in_think_block, is_last_update=True
+                            )
+                            active_message_object = None
+                        current_text_segment = ""
+                        is_in_think_block = stream_parser.in_reasoning
+
+                # Edits are coalesced and rate limited by the edit scheduler
+                if len(current_text_segment) > SAFE_MAX_LEN or current_text_segment.strip():
+
+                    text_to_format_and_send = current_text_segment
+                    temp_remaining_text = ""
+
+                    is_last_current_message_update = False
+                    if len(current_text_segment) > SAFE_MAX_LEN:
+                        split_at = SAFE_MAX_LEN
+
+                        text_to_format_and_send = current_text_segment[:split_at]
+                        temp_remaining_text = current_text_segment[split_at:]
+                        is_last_current_message_update = True
+
+                    if text_to_format_and_send.strip() or (
+                            active_message_object and active_message_object.text == "⏳"):
+                        active_message_object = await send_or_update_formatted_message(
+                            bot, message.chat.id, text_to_format_and_send, active_message_object, is_in_think_block,
+                            is_last_update=is_last_current_message_update, wait=is_last_current_message_update,
+                            reply_markup=None if is_last_current_message_update else stop_markup)
+
+                    if temp_remaining_text.strip():
+                        current_text_segment = temp_remaining_text
+                    if temp_remaining_text.strip():
+                        if active_message_object and text_to_format_and_send.strip():
+                            active_message_object = None
+
+            for segment in stream_parser.close():
+                current_text_segment += segment.text
+                if segment.kind == services.stream_parser.CONTENT:
+                    response_parts.append(segment.text)
+
+            if current_text_segment.strip():
+                active_message_object = await send_or_update_formatted_message(
+                    bot=bot, chat_id=message.chat.id, text_content=current_text_segment,
+                    current_message_obj=active_message_object, is_think_block_content=is_in_think_block
+                )
+
+        # The proxy reports errors after the stream started with an error frame, the shown part stays
+        is_successful = stream_parser.error is None
+        if not is_successful:
+            logging.info(f"AI stream error: {stream_parser.error[:500]}")
+            error_text = "Error: The AI response was interrupted."
+            if active_message_object and not response_parts and not current_text_segment.strip():
+                # Nothing was shown yet: replace "⏳", which also removes its Stop button
+                active_message_object = await send_or_update_formatted_message(bot, message.chat.id, error_text,
+                                                                               active_message_object, False)
+            else:
+                await message.answer(error_text)
+
+    except services.ai_service.StreamError as e:
+        logging.info(f"AI stream error: {e}")
+        await send_or_update_formatted_message(bot, message.chat.id, "AI Error: Unsupported response format.",
+                                               active_message_object, False)
+    except asyncio.CancelledError:
+        if not active_stream.stopped:
+            raise
+        # Stopped by the user: the closed connection aborts the generation in the proxy, the shown part stays
+        asyncio.current_task().uncancel()
+        if current_text_segment.strip():
+            await send_or_update_formatted_message(bot, message.chat.id, current_text_segment, active_message_object,
+                                                   is_in_think_block, is_last_update=True)
+        elif active_message_object:
+            await send_or_update_formatted_message(bot, message.chat.id, strings.STOP_STREAM.STOPPED,
+                                                   active_message_object, False)
     except aiohttp.ClientError as e:
         err_msg = "Error: Could not connect to AI service."
         if active_message_object:
@@ -512,7 +533,25 @@ async def other_text_handler(message: types.Message,
         else:
             await message.answer(err_msg)
         raise e
-
-    services.message_service.add_message(session, message.text, user)
+    finally:
+        services.stream_control.control.unregister(active_stream)
+
+    # Written in batches by the persistence worker
+    full_response_for_history = "".join(response_parts)
+    persistence_worker = services.persistence_worker.worker
+    if is_successful:
+        await persistence_worker.increment(user.id, "successful_requests")
+    await persistence_worker.add_message(user.id, message.text, epoch=user.context_epoch)
     if full_response_for_history:
-        services.message_service.add_message(session, full_response_for_history, user, is_from_user=False)
+        await persistence_worker.add_message(user.id, full_response_for_history, is_from_user=False,
+                                             epoch=user.context_epoch)
+    usage = stream_parser.usage
+    if usage is None and full_response_for_history:
+        # The stream broke before its usage frame, tokens of the shown part are estimated
+        usage = {"prompt_tokens": sum(services.tokens.estimate_tokens(m["content"]) for m in ai_messages),
+                 "completion_tokens": services.tokens.estimate_tokens(full_response_for_history)}
+    if usage is not None:
+        await services.usage_service.counters.record(user.id, ai_model, usage.get("prompt_tokens", 0),
+                                                     usage.get("completion_tokens", 0))
+    if user.context_mode_on:
+        services.message_service.schedule_compaction(user.id, user.context_epoch, ai_model, http_session)
@@ -0,0 +1,68 @@
+import json
+import os
+import urllib.parse
+
+import aiohttp
+
+import services.stream_parser
+
+
+class StreamError(Exception):
+    """The proxy stream ended with an error frame or without `done`"""
+
+
+def get_stream_url() -> str:
+    return os.getenv("AI_STREAM_URL", "http://127.0.0.1:5050/stream/")
+
+
+def get_models_url() -> str:
+    return os.getenv("AI_MODELS_URL") or urllib.parse.urljoin(get_stream_url(), "/v1/models")
+
+
+def get_api_key() -> str:
+    return os.getenv("AI_API_KEY", "dac877e7-4afd-4aa4-9c6f-97eedea5810c")
+
+
+def check_stream_protocol(response: aiohttp.ClientResponse):
+    """Raises `StreamError` if the proxy streams another protocol version than `StreamParser` reads"""
+    version = response.headers.get(services.stream_parser.PROTOCOL_HEADER)
+    if version != services.stream_parser.PROTOCOL_VERSION:
+        raise StreamError(f"Unsupported stream protocol: {version}")
+
+
+def build_request_data(model: str, messages: list[dict], user_id: int | None = None, cache: bool = False) -> dict:
+    """`user_id` lets the proxy share provider capacity fairly between users,
+    `cache` allows the proxy to answer with a cached response to the same messages"""
+    data = {
+        "model": model,
+        "messages": messages,
+        "api_key": get_api_key()
+    }
+    if user_id is not None:
+        data["user"] = str(user_id)
+    if cache:
+        data["cache"] = True
+    return data
+
+
+async def complete(http_session: aiohttp.ClientSession, model: str, messages: list[dict],
+                   user_id: int | None = None) -> str:
+    """Reads the whole answer from the proxy stream, reasoning is skipped.
+
+    Raises `aiohttp.ClientResponseError` if the proxy doesn't answer with 200
+    and `StreamError` if the stream fails after it started.
+    """
+    headers = {"Content-Type": "application/json"}
+    data = json.dumps(build_request_data(model, messages, user_id))
+    parser = services.stream_parser.StreamParser()
+    content_parts = []
+    async with http_session.post(get_stream_url(), data=data, headers=headers) as response:
+        response.raise_for_status()
+        check_stream_protocol(response)
+        async for chunk_bytes in response.content.iter_any():
+            content_parts += [segment.text for segment in parser.feed(chunk_bytes)
+                              if segment.kind == services.stream_parser.CONTENT]
+    content_parts += [segment.text for segment in parser.close() if segment.kind == services.stream_parser.CONTENT]
+    if parser.error is not None:
+        raise StreamError(parser.error)
+    return "".join(content_parts)
@@ -0,0 +1,135 @@
+import collections
+import time
+import typing
+
+import settings
+
+# (role, content, token_count) in OpenAI roles, oldest first
+ContextRow = tuple[str, str, int]
+
+_ROW_OVERHEAD_BYTES = 64  # rough size of the tuple and ints
+
+
+class _Entry:
+    __slots__ = ("rows", "epoch", "size", "loaded_at")
+
+    def __init__(self, rows: typing.Iterable[ContextRow], epoch: int, max_rows: int):
+        self.rows: collections.deque[ContextRow] = collections.deque(maxlen=max_rows)
+        self.epoch = epoch
+        self.size = 0
+        self.loaded_at = time.monotonic()
+        for row in rows:
+            self.append(row)
+
+    def append(self, row: ContextRow) -> int:
+        """Appends a row and returns the change of size"""
+        before = self.size
+        if len(self.rows) == self.rows.maxlen:
+            self.size -= _row_size(self.rows[0])
+        self.rows.append(row)
+        self.size += _row_size(row)
+        return self.size - before
+
+
+def make_row(is_from_user: bool, content: str, token_count: int) -> ContextRow:
+    return "user" if is_from_user else "assistant", content, token_count
+
+
+def _row_size(row: ContextRow) -> int:
+    return len(row[1]) + _ROW_OVERHEAD_BYTES
+
+
+class ContextCache:
+    """Process-wide LRU cache of the recent history of active users.
+
+    Entries expire `ttl` seconds after loading, least recently used entries are evicted
+    when `max_users` or `max_bytes` is exceeded.
+    """
+
+    def __init__(self,
+                 max_users: int = settings.CONTEXT_CACHE_MAX_USERS,
+                 max_bytes: int = settings.CONTEXT_CACHE_MAX_BYTES,
+                 ttl: float = settings.CONTEXT_CACHE_TTL_SEC,
+                 max_rows: int = settings.CONTEXT_MAX_MESSAGES):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_rows = max_rows
+
+        self._entries: collections.OrderedDict[int, _Entry] = collections.OrderedDict()
+        self._loading: dict[int, bool] = {}  # user id -> changed while loading from DB
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int, epoch: int) -> collections.deque[ContextRow] | None:
+        entry = self._entries.get(user_id)
+        if entry is None or entry.epoch != epoch or time.monotonic() - entry.loaded_at > self.ttl:
+            if entry is not None:
+                self._remove(user_id)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry.rows
+
+    def peek(self, user_id: int) -> collections.deque[ContextRow] | None:
+        """Same as `get`, but doesn't touch LRU order and counters"""
+        entry = self._entries.get(user_id)
+        return entry.rows if entry is not None else None
+
+    def begin_load(self, user_id: int):
+        """Marks start of a DB read, `put` is skipped if the history changes before it finishes"""
+        self._loading[user_id] = False
+
+    def cancel_load(self, user_id: int):
+        self._loading.pop(user_id, None)
+
+    def put(self, user_id: int, rows: typing.Iterable[ContextRow], epoch: int):
+        changed = self._loading.pop(user_id, False)
+        if changed:
+            return
+        self._remove(user_id)
+        entry = _Entry(rows, epoch, self.max_rows)
+        self._entries[user_id] = entry
+        self.size += entry.size
+        self._evict()
+
+    def append(self, user_id: int, row: ContextRow, epoch: int):
+        """Write-through of a new message, messages of an old epoch are ignored"""
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        entry = self._entries.get(user_id)
+        if entry is None or entry.epoch != epoch:
+            return
+        self.size += entry.append(row)
+        self._evict()
+
+    def invalidate(self, user_id: int):
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        self._remove(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_users or self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+
+cache = ContextCache()
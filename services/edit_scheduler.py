@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import time
+
+import aiogram
+import aiogram.exceptions
+from aiogram import types
+
+import settings
+
+
+class TokenBucket:
+    """Simple token bucket, `rate` tokens per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0  # set on TelegramRetryAfter
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Returns seconds until a token is available"""
+        self._refill(now)
+        wait_for_token = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait_for_token, self.blocked_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _PendingEdit:
+    __slots__ = ("bot", "chat_id", "message_id", "text", "parse_mode", "reply_markup", "future", "urgent")
+
+    def __init__(self, bot: aiogram.Bot, chat_id: int, message_id: int, text: str, parse_mode: str | None,
+                 reply_markup: types.InlineKeyboardMarkup | None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.future: asyncio.Future | None = None  # only if somebody waits for the result
+        self.urgent = False
+
+
+class _MessageStats:
+    """Edit history of one message, used to adapt the edit interval"""
+    __slots__ = ("last_edit_at", "last_text", "last_reply_markup", "stream_rate", "last_submit_at", "last_submit_len")
+
+    def __init__(self, now: float):
+        self.last_edit_at = 0.0
+        self.last_text = None
+        self.last_reply_markup = None
+        self.stream_rate = 0.0  # EWMA of incoming chars per second
+        self.last_submit_at = now
+        self.last_submit_len = 0
+
+
+class EditScheduler:
+    """Central queue for streaming message edits.
+
+    Edits are limited by a global token bucket (Telegram's ~30 msg/s cap) and a bucket
+    per chat. Only the latest text for every message is kept, older pending texts are
+    dropped. `TelegramRetryAfter` blocks the chat bucket for the requested time and
+    the edit stays in the queue.
+    """
+
+    def __init__(self,
+                 global_rate: float = settings.EDIT_GLOBAL_RATE,
+                 private_chat_rate: float = settings.EDIT_PRIVATE_CHAT_RATE,
+                 group_chat_rate: float = settings.EDIT_GROUP_CHAT_RATE,
+                 min_interval: float = settings.EDIT_MIN_INTERVAL_SEC,
+                 max_interval: float = settings.EDIT_MAX_INTERVAL_SEC):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._pending: dict[tuple[int, int], _PendingEdit] = {}
+        self._in_flight: set[tuple[int, int]] = set()
+        self._stats: dict[tuple[int, int], _MessageStats] = {}
+        self._last_cleanup_at = time.monotonic()
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+        self._closing = False
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels, they have a much lower limit
+            rate = self.group_chat_rate if chat_id < 0 else self.private_chat_rate
+            bucket = TokenBucket(rate, max(1.0, rate))
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _interval(self, stats: _MessageStats, text: str) -> float:
+        """Edit interval for a message: longer messages and fast streams are edited less often"""
+        interval = self.min_interval + len(text) * settings.EDIT_INTERVAL_PER_CHAR_SEC
+        if stats.stream_rate > 0:
+            # Aim for at least EDIT_MIN_NEW_CHARS new characters per edit
+            interval = max(interval, settings.EDIT_MIN_NEW_CHARS / stats.stream_rate)
+        return min(interval, self.max_interval)
+
+    def _cleanup(self, now: float):
+        """Drops stats of idle messages and full chat buckets"""
+        self._last_cleanup_at = now
+        for key, stats in list(self._stats.items()):
+            if now - stats.last_submit_at > settings.EDIT_STATS_TTL_SEC and key not in self._pending:
+                del self._stats[key]
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    def submit(self, bot: aiogram.Bot, chat_id: int, message_id: int, text: str,
+               parse_mode: str | None = None,
+               reply_markup: types.InlineKeyboardMarkup | None = None,
+               wait: bool = False) -> asyncio.Future | None:
+        """Queues an edit, replacing any pending text of the same message.
+
+        If `wait` is set, the edit is sent as soon as limits allow and a future with the
+        edited message (or the Telegram error) is returned.
+        """
+        self._ensure_worker()
+        now = time.monotonic()
+        key = (chat_id, message_id)
+        if now - self._last_cleanup_at > settings.EDIT_STATS_TTL_SEC:
+            self._cleanup(now)
+
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _MessageStats(now)
+        elapsed = now - stats.last_submit_at
+        if elapsed > 0 and len(text) >= stats.last_submit_len:
+            rate = (len(text) - stats.last_submit_len) / elapsed
+            stats.stream_rate = rate if stats.stream_rate == 0 else 0.7 * stats.stream_rate + 0.3 * rate
+        stats.last_submit_at = now
+        stats.last_submit_len = len(text)
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _PendingEdit(bot, chat_id, message_id, text, parse_mode, reply_markup)
+        else:
+            pending.text = text
+            pending.parse_mode = parse_mode
+            pending.reply_markup = reply_markup
+
+        if wait:
+            pending.urgent = True
+            # A waiter may have been cancelled; a cancelled future must not be handed to the next one
+            if pending.future is None or pending.future.done():
+                pending.future = asyncio.get_running_loop().create_future()
+        self._wakeup.set()
+        return pending.future if wait else None
+
+    async def edit(self, bot: aiogram.Bot, chat_id: int, message_id: int, text: str,
+                   parse_mode: str | None = None,
+                   reply_markup: types.InlineKeyboardMarkup | None = None) -> types.Message | None:
+        """Queues an edit and waits until it is sent"""
+        return await self.submit(bot, chat_id, message_id, text, parse_mode, reply_markup, wait=True)
+
+    async def acquire(self, chat_id: int):
+        """Waits for a free slot in global and chat limits, used before sending new messages"""
+        while True:
+            now = time.monotonic()
+            chat_bucket = self._chat_bucket(chat_id)
+            delay = max(self.global_bucket.delay(now), chat_bucket.delay(now))
+            if delay <= 0:
+                self.global_bucket.take(now)
+                chat_bucket.take(now)
+                return
+            await asyncio.sleep(delay)
+
+    def forget(self, chat_id: int, message_id: int):
+        """Drops the edit history of a message that won't be edited anymore"""
+        self._stats.pop((chat_id, message_id), None)
+
+    def _ready_at(self, key: tuple[int, int], pending: _PendingEdit, now: float) -> float:
+        stats = self._stats[key]
+        ready_at = now + self._chat_bucket(pending.chat_id).delay(now)
+        if not pending.urgent:
+            ready_at = max(ready_at, stats.last_edit_at + self._interval(stats, pending.text))
+        return ready_at
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            next_key, next_ready_at = None, None
+            for key, pending in self._pending.items():
+                if key in self._in_flight:
+                    continue
+                ready_at = self._ready_at(key, pending, now)
+                if next_ready_at is None or ready_at < next_ready_at:
+                    next_key, next_ready_at = key, ready_at
+
+            if next_key is None:
+                if self._closing and not self._in_flight:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = max(next_ready_at - now, self.global_bucket.delay(now))
+            if delay > 0 and not self._closing:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+
+            pending = self._pending.pop(next_key)
+            self.global_bucket.take(now)
+            self._chat_bucket(pending.chat_id).take(now)
+            self._in_flight.add(next_key)
+            asyncio.create_task(self._send(next_key, pending))
+
+    async def _send(self, key: tuple[int, int], pending: _PendingEdit):
+        stats = self._stats.get(key)
+        result = None
+        error = None
+        try:
+            # Same text and keyboard as the last successful edit would be "message is not modified" anyway
+            if stats is None or stats.last_text != pending.text or stats.last_reply_markup != pending.reply_markup:
+                result = await pending.bot.edit_message_text(
+                    text=pending.text,
+                    chat_id=pending.chat_id,
+                    message_id=pending.message_id,
+                    reply_markup=pending.reply_markup,
+                    parse_mode=pending.parse_mode
+                )
+                if stats is not None:
+                    stats.last_text = pending.text
+                    stats.last_reply_markup = pending.reply_markup
+        except aiogram.exceptions.TelegramRetryAfter as e:
+            logging.warning(f"Edit of message {pending.message_id} hit flood control, retry in {e.retry_after}s")
+            self._chat_bucket(pending.chat_id).blocked_until = time.monotonic() + e.retry_after
+            # Put it back unless a newer text has been queued meanwhile
+            newer = self._pending.get(key)
+            if newer is None:
+                self._pending[key] = pending
+            elif pending.future is not None and (newer.future is None or newer.future.done()):
+                newer.future, newer.urgent = pending.future, True
+            pending = None
+        except aiogram.exceptions.TelegramBadRequest as e:
+            if "message is not modified" not in str(e).lower():
+                error = e
+        except Exception as e:
+            error = e
+        finally:
+            if stats is not None:
+                stats.last_edit_at = time.monotonic()
+            self._in_flight.discard(key)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+        if pending is None or pending.future is None:
+            if error is not None:
+                logging.warning(f"Background edit of message {key[1]} in chat {key[0]} failed: {error}")
+            return
+        if pending.future.done():
+            return
+        if error is not None:
+            pending.future.set_exception(error)
+        else:
+            pending.future.set_result(result)
+
+    async def close(self):
+        """Sends all pending edits without waiting for intervals and stops the worker"""
+        self._closing = True
+        if self._worker is None:
+            return
+        for pending in self._pending.values():
+            pending.urgent = True
+        self._wakeup.set()
+        await self._worker
+        self._worker = None
+        self._closing = False
+
+
+scheduler = EditScheduler()
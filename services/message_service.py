@@ -1,19 +1,33 @@
+import asyncio
+import logging
 import typing
 
 import aiogram
+import aiohttp
+import sqlalchemy as sa
 import sqlalchemy.orm
 import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
 
+import settings
+import strings
 import models.db_session
 import models.user
 import models.message
+import services.ai_service
+import services.context_cache
+import services.persistence_worker
+import services.tokens
+import services.user_cache
 
 def add_message(session: sqlalchemy.orm.Session, content: str, user: models.user.User, is_from_user: bool=True):
     """add message to messages table"""
     new_message = models.message.Message(
         content=content,
         owner_id=user.id,
-        is_from_user=is_from_user
+        is_from_user=is_from_user,
+        token_count=services.tokens.estimate_tokens(content),
+        epoch=user.context_epoch
     )
     try:
         session.add(new_message)
@@ -21,23 +35,306 @@ def add_message(session: sqlalchemy.orm.Session, content: str, user: models.user
     except sqlalchemy.exc.SQLAlchemyError as error:
         print(f"Failed to add message for user {user.id}: {error}")
         raise
+    services.context_cache.cache.append(user.id, services.context_cache.make_row(is_from_user, content,
+                                                                                 new_message.token_count),
+                                        user.context_epoch)
 
 def delete_messages(session: sqlalchemy.orm.Session, user: models.user.User):
-    """delete all messages that belongs to specified user"""
+    """clear context of specified user by starting a new context epoch.
+
+    Rows of old epochs are invisible to context queries and deleted later by `purge_cleared_messages`.
+    """
+    services.context_cache.cache.invalidate(user.id)
+    services.user_cache.invalidate_after_commit(session, user.id)
     try:
-        messages_to_delete = session.query(models.message.Message).filter(models.message.Message.owner_id == user.id).all()
-        for msg in messages_to_delete:
-            session.delete(msg)
+        user.context_epoch += 1
+        session.add(user)
         session.flush()
     except sqlalchemy.exc.SQLAlchemyError as error:
         print(f"Failed to delete messages for user {user.id}: {error}")
         raise
 
-def get_context_messages(session: sqlalchemy.orm.Session, user: models.user.User):
-    """returns list of dicts with messages for specified user chat in OpenAI format"""
-    messages = user.messages
+def _summary_query(user_id: int, epoch: int):
+    """The latest rolling summary of the user's history"""
+    return (
+        sa.select(models.message.Message.content, models.message.Message.token_count,
+                  models.message.Message.summary_until_id)
+        .where(models.message.Message.owner_id == user_id, models.message.Message.epoch == epoch,
+               models.message.Message.is_summary.is_(True))
+        .order_by(models.message.Message.id.desc())
+        .limit(1)
+    )
+
+
+def _context_query(user_id: int, epoch: int, after_id: int | None):
+    """Newest messages that are not covered by a summary first, served by the (owner_id, epoch, id) index"""
+    query = (
+        sa.select(models.message.Message.is_from_user, models.message.Message.content,
+                  models.message.Message.token_count)
+        .where(models.message.Message.owner_id == user_id, models.message.Message.epoch == epoch,
+               models.message.Message.is_summary.is_(False))
+        .order_by(models.message.Message.id.desc())
+        .limit(settings.CONTEXT_MAX_MESSAGES)
+    )
+    if after_id is not None:
+        query = query.where(models.message.Message.id > after_id)
+    return query
+
+
+def _load_rows(user: models.user.User | services.user_cache.UserSettings, summary,
+               newest_first_rows: typing.Iterable[tuple[bool, str, int | None]]):
+    """Oldest-first context rows: summary, DB result and messages still queued in the persistence worker"""
+    rows = [services.context_cache.make_row(is_from_user, content,
+                                            token_count if token_count is not None
+                                            else services.tokens.estimate_tokens(content))
+            for is_from_user, content, token_count in newest_first_rows]
+    if summary is not None:
+        rows.append(("system", strings.CONTEXT_SUMMARY_PREFIX + summary.content, summary.token_count))
+    rows.reverse()
+    rows += services.persistence_worker.worker.pending_messages(user.id, user.context_epoch)
+    return rows
+
+
+async def _select_context_rows(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                               user: models.user.User | services.user_cache.UserSettings):
+    summary = (await models.db_session.execute(session, _summary_query(user.id, user.context_epoch))).first()
+    result = await models.db_session.execute(session, _context_query(user.id, user.context_epoch,
+                                                                     summary and summary.summary_until_id))
+    return _load_rows(user, summary, result)
+
+
+def _build_context(rows: typing.Sequence[services.context_cache.ContextRow], token_budget: int | None) -> list[dict]:
+    """Takes the newest rows until `token_budget` is used up"""
     context = []
-    for msg in messages:
-        role = "user" if msg.is_from_user else "assistant"
-        context.append({"role": role, "content": msg.content})
-    return context
\ No newline at end of file
+    used_tokens = 0
+    for role, content, token_count in reversed(rows):
+        if token_budget is not None and used_tokens + token_count > token_budget:
+            break
+        used_tokens += token_count
+        context.append({"role": role, "content": content})
+    context.reverse()
+    return context
+
+
+def get_context_messages(session: sqlalchemy.orm.Session, user: models.user.User, token_budget: int | None = None):
+    """returns list of dicts with the newest messages for specified user chat in OpenAI format,
+    that fit in `token_budget` tokens"""
+    cache = services.context_cache.cache
+    rows = cache.get(user.id, user.context_epoch)
+    if rows is None:
+        cache.begin_load(user.id)
+        try:
+            summary = session.execute(_summary_query(user.id, user.context_epoch)).first()
+            result = session.execute(_context_query(user.id, user.context_epoch, summary and summary.summary_until_id))
+            rows = _load_rows(user, summary, result)
+        except Exception:
+            cache.cancel_load(user.id)
+            raise
+        cache.put(user.id, rows, user.context_epoch)
+    return _build_context(rows, token_budget)
+
+
+async def add_message_async(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession, content: str,
+                            user: models.user.User, is_from_user: bool = True):
+    """async version of `add_message`, falls back to it for sync session"""
+    if not models.db_session.is_async_session(session):
+        return add_message(session, content, user, is_from_user)
+
+    new_message = models.message.Message(
+        content=content,
+        owner_id=user.id,
+        is_from_user=is_from_user,
+        token_count=services.tokens.estimate_tokens(content),
+        epoch=user.context_epoch
+    )
+    try:
+        session.add(new_message)
+        await session.flush()
+    except sqlalchemy.exc.SQLAlchemyError as error:
+        print(f"Failed to add message for user {user.id}: {error}")
+        raise
+    services.context_cache.cache.append(user.id, services.context_cache.make_row(is_from_user, content,
+                                                                                 new_message.token_count),
+                                        user.context_epoch)
+
+
+async def delete_messages_async(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                                user: models.user.User):
+    """async version of `delete_messages`, falls back to it for sync session"""
+    if not models.db_session.is_async_session(session):
+        return delete_messages(session, user)
+
+    services.context_cache.cache.invalidate(user.id)
+    services.user_cache.invalidate_after_commit(session, user.id)
+    try:
+        user.context_epoch += 1
+        session.add(user)
+        await session.flush()
+    except sqlalchemy.exc.SQLAlchemyError as error:
+        print(f"Failed to delete messages for user {user.id}: {error}")
+        raise
+
+
+async def get_context_messages_async(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                                     user: models.user.User, token_budget: int | None = None):
+    """async version of `get_context_messages`, falls back to it for sync session"""
+    if not models.db_session.is_async_session(session):
+        return get_context_messages(session, user, token_budget)
+
+    rows = await _get_rows_async(user, lambda: _select_context_rows(session, user))
+    return _build_context(rows, token_budget)
+
+
+async def load_context_messages(user: models.user.User | services.user_cache.UserSettings,
+                                token_budget: int | None = None):
+    """Same as `get_context_messages_async`, but opens a short session only on a cache miss"""
+    async def select_rows():
+        async with models.db_session.session_scope() as session:
+            return await _select_context_rows(session, user)
+
+    rows = await _get_rows_async(user, select_rows)
+    return _build_context(rows, token_budget)
+
+
+async def _get_rows_async(user: models.user.User | services.user_cache.UserSettings,
+                          select_rows: typing.Callable[[], typing.Awaitable[list]]):
+    """Context rows from the cache, `select_rows` loads them from DB on a miss"""
+    cache = services.context_cache.cache
+    rows = cache.get(user.id, user.context_epoch)
+    if rows is None:
+        cache.begin_load(user.id)
+        try:
+            rows = await select_rows()
+        except Exception:
+            cache.cancel_load(user.id)
+            raise
+        cache.put(user.id, rows, user.context_epoch)
+    return rows
+
+
+_compaction_tasks: dict[int, asyncio.Task] = {}
+
+
+def schedule_compaction(user_id: int, epoch: int, model: str, http_session: aiohttp.ClientSession):
+    """Starts background compaction if the cached history of the user is above the threshold"""
+    if not settings.COMPACTION_ENABLED or user_id in _compaction_tasks:
+        return
+    rows = services.context_cache.cache.peek(user_id)
+    if rows is None:
+        return
+    threshold = services.tokens.get_context_budget(model) * settings.COMPACTION_THRESHOLD_RATIO
+    if sum(token_count for _, _, token_count in rows) < threshold:
+        return
+
+    task = asyncio.create_task(compact_history(user_id, epoch, model, http_session))
+    _compaction_tasks[user_id] = task
+    task.add_done_callback(lambda _: _compaction_tasks.pop(user_id, None))
+
+
+async def compact_history(user_id: int, epoch: int, model: str, http_session: aiohttp.ClientSession):
+    """Summarizes older messages of the user through the proxy and stores the summary as a special message.
+
+    The newest messages within COMPACTION_KEEP_RATIO of the context budget are left as they are.
+    Summarized messages stay in the table, context just starts from the latest summary.
+    """
+    budget = services.tokens.get_context_budget(model)
+    await services.persistence_worker.worker.flush()
+    async with models.db_session.session_scope() as session:
+        summary = (await models.db_session.execute(session, _summary_query(user_id, epoch))).first()
+        query = (
+            sa.select(models.message.Message.id, models.message.Message.is_from_user,
+                      models.message.Message.content, models.message.Message.token_count)
+            .where(models.message.Message.owner_id == user_id, models.message.Message.epoch == epoch,
+                   models.message.Message.is_summary.is_(False))
+            .order_by(models.message.Message.id)
+        )
+        if summary is not None and summary.summary_until_id is not None:
+            query = query.where(models.message.Message.id > summary.summary_until_id)
+        rows = (await models.db_session.execute(session, query)).all()
+
+    def tokens_of(row) -> int:
+        return row.token_count if row.token_count is not None else services.tokens.estimate_tokens(row.content)
+
+    kept_tokens = 0
+    cut = len(rows)
+    while cut > 0 and kept_tokens + tokens_of(rows[cut - 1]) <= budget * settings.COMPACTION_KEEP_RATIO:
+        cut -= 1
+        kept_tokens += tokens_of(rows[cut])
+
+    # One summarization request must fit in the budget too, the rest goes to the next compaction
+    to_summarize = []
+    summarize_tokens = summary.token_count if summary is not None else 0
+    for row in rows[:cut]:
+        summarize_tokens += tokens_of(row)
+        if to_summarize and summarize_tokens > budget:
+            break
+        to_summarize.append(row)
+    if not to_summarize:
+        return
+
+    transcript = "\n\n".join(f"{'User' if row.is_from_user else 'Assistant'}: {row.content}" for row in to_summarize)
+    if summary is not None:
+        transcript = strings.CONTEXT_SUMMARY_PREFIX + summary.content + "\n\n" + transcript
+    try:
+        summary_text = await services.ai_service.complete(http_session, settings.COMPACTION_MODEL or model, [
+            {"role": "system", "content": strings.COMPACTION_INSTRUCTIONS},
+            {"role": "user", "content": transcript}
+        ], user_id)
+    except Exception as error:
+        logging.warning(f"History compaction for user {user_id} failed: {error}")
+        return
+    if not summary_text.strip():
+        return
+
+    summary_until_id = to_summarize[-1].id
+    async with models.db_session.session_scope() as session:
+        # History could be cleared while the summary was generated
+        current_epoch = (await models.db_session.execute(
+            session, sa.select(models.user.User.context_epoch).where(models.user.User.id == user_id)
+        )).scalar_one_or_none()
+        if current_epoch != epoch:
+            return
+        session.add(models.message.Message(
+            owner_id=user_id,
+            is_from_user=False,
+            is_summary=True,
+            content=summary_text,
+            token_count=services.tokens.estimate_tokens(strings.CONTEXT_SUMMARY_PREFIX + summary_text),
+            epoch=epoch,
+            summary_until_id=summary_until_id
+        ))
+    services.context_cache.cache.invalidate(user_id)
+    logging.info(f"Compacted {len(to_summarize)} messages of user {user_id}")
+
+
+async def purge_cleared_messages(batch_size: int = settings.PURGE_BATCH_SIZE) -> int:
+    """Deletes messages of old context epochs with set-based DELETE statements, returns number of deleted rows"""
+    users = models.user.User.__table__
+    messages = models.message.Message.__table__
+    old_ids = (
+        sa.select(messages.c.id)
+        .join(users, users.c.id == messages.c.owner_id)
+        .where(messages.c.epoch < users.c.context_epoch)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    deleted = 0
+    while True:
+        # Short transaction per batch, so writers are not blocked for long
+        async with models.db_session.session_scope() as session:
+            result = await models.db_session.execute(session, sa.delete(messages).where(messages.c.id.in_(old_ids)))
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+async def run_purge_job(interval: float = settings.PURGE_INTERVAL_SEC):
+    """Background job that periodically deletes cleared history"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await purge_cleared_messages()
+            if deleted:
+                logging.info(f"Purged {deleted} cleared messages")
+        except sqlalchemy.exc.SQLAlchemyError as error:
+            logging.warning(f"Failed to purge cleared messages: {error}")
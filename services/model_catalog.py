@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+import services.ai_service
+import settings
+import strings
+
+
+class ModelCatalog:
+    """Models offered by the proxy, read from its `/v1/models`.
+
+    Handlers read `models` without any I/O. `refresh` asks the proxy only after the TTL and
+    with `If-None-Match`, so an unchanged catalog costs a 304 without a body. Until the first
+    successful fetch `strings.MODELS` is used.
+    """
+
+    def __init__(self, ttl: float = settings.MODEL_CATALOG_TTL_SEC):
+        self.ttl = ttl
+        self.models: dict[str, str] = dict(strings.MODELS)  # model id -> display name
+        self._etag: str | None = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self._checked_at < self.ttl
+
+    async def refresh(self, http_session: aiohttp.ClientSession, force: bool = False):
+        if not force and self.is_fresh():
+            return
+        async with self._lock:
+            if not force and self.is_fresh():
+                return
+            headers = {"Authorization": f"Bearer {services.ai_service.get_api_key()}"}
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            try:
+                async with http_session.get(services.ai_service.get_models_url(), headers=headers) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        models = {model["id"]: model.get("name") or model["id"] for model in data["data"]}
+                        if models:
+                            self.models = models
+                            self._etag = response.headers.get("ETag")
+                    elif response.status != 304:
+                        logging.warning(f"Failed to load the model catalog: HTTP {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as error:
+                logging.warning(f"Failed to load the model catalog: {error!r}")
+            # Failures are retried after the TTL as well, the last known catalog stays meanwhile
+            self._checked_at = time.monotonic()
+
+
+catalog = ModelCatalog()
+
+
+async def run_refresh_job(http_session: aiohttp.ClientSession, interval: float = settings.MODEL_CATALOG_TTL_SEC):
+    """Background job that keeps the catalog current"""
+    while True:
+        await catalog.refresh(http_session, force=True)
+        await asyncio.sleep(interval)
@@ -0,0 +1,240 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.dialects.sqlite
+
+import settings
+import models.db_session
+import models.message
+import models.usage
+import models.user
+import services.context_cache
+import services.tokens
+
+COUNTER_FIELDS = {"requests", "successful_requests"}
+
+
+class PersistenceWorker:
+    """Write-behind queue for message history, user counters and token usage.
+
+    Request handlers only put items into a bounded queue, the worker commits them in
+    batches: messages with one executemany INSERT, counters with atomic
+    `UPDATE users SET x = x + n` grouped by user, usage with one upsert per (user, model, day).
+    """
+
+    def __init__(self,
+                 max_queue_size: int = settings.PERSIST_QUEUE_SIZE,
+                 batch_size: int = settings.PERSIST_BATCH_SIZE,
+                 flush_interval: float = settings.PERSIST_FLUSH_INTERVAL_SEC,
+                 max_retries: int = settings.PERSIST_MAX_RETRIES):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self._queue: asyncio.Queue | None = None
+        self._pending_messages: dict[int, list[tuple]] = {}  # queued, not committed messages by user id
+        self._task: asyncio.Task | None = None
+        self.metrics = {
+            "enqueued": 0,
+            "messages_written": 0,
+            "counter_updates": 0,
+            "usage_updates": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "dropped_items": 0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0.0,
+        }
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Writes everything left in the queue and stops the worker"""
+        if not self.is_running:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logging.info(f"Persistence worker stopped: {self.metrics}")
+
+    async def flush(self):
+        """Waits until all queued items are committed"""
+        if self.is_running:
+            await self._queue.join()
+
+    def pending_messages(self, user_id: int, epoch: int) -> list[services.context_cache.ContextRow]:
+        """Context rows of messages that are queued but not committed yet, oldest first"""
+        return [services.context_cache.make_row(is_from_user, content, token_count)
+                for _, _, content, is_from_user, token_count, message_epoch in self._pending_messages.get(user_id, ())
+                if message_epoch == epoch]
+
+    async def _put(self, item: tuple):
+        # Without running worker (e.g. scripts) items are written at once
+        if not self.is_running:
+            await self._write_batch([item])
+            return
+        if item[0] == "message":
+            self._pending_messages.setdefault(item[1], []).append(item)
+        await self._queue.put(item)  # blocks when the queue is full
+        self.metrics["enqueued"] += 1
+
+    def _release(self, batch: list[tuple]):
+        for item in batch:
+            if item[0] != "message":
+                continue
+            user_messages = self._pending_messages.get(item[1])
+            if user_messages:
+                user_messages.remove(item)
+                if not user_messages:
+                    del self._pending_messages[item[1]]
+
+    async def add_message(self, user_id: int, content: str, is_from_user: bool = True, epoch: int = 0):
+        """Queues a message, `epoch` is the user's context epoch when the message was written"""
+        token_count = services.tokens.estimate_tokens(content)
+        services.context_cache.cache.append(user_id, services.context_cache.make_row(is_from_user, content, token_count),
+                                            epoch)
+        await self._put(("message", user_id, content, is_from_user, token_count, epoch))
+
+    async def increment(self, user_id: int, field: str, amount: int = 1):
+        if field not in COUNTER_FIELDS:
+            raise ValueError(f"Unknown counter {field}")
+        await self._put(("counter", user_id, field, amount))
+
+    async def add_usage(self, user_id: int, model: str, day: datetime.date, prompt_tokens: int,
+                        completion_tokens: int):
+        """Queues one request with its tokens for the daily usage counters"""
+        await self._put(("usage", user_id, model, day, prompt_tokens, completion_tokens))
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._write_batch_with_retries(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write_batch_with_retries(self, batch: list[tuple]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._write_batch(batch)
+                return
+            except Exception as error:
+                self.metrics["failed_batches"] += 1
+                logging.warning(f"Failed to write batch of {len(batch)} items (attempt {attempt + 1}): {error}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        self.metrics["dropped_items"] += len(batch)
+        self._release(batch)
+        logging.error(f"Dropped batch of {len(batch)} items after {self.max_retries + 1} attempts")
+
+    async def _write_batch(self, batch: list[tuple]):
+        started_at = time.monotonic()
+        messages = []
+        counters = collections.defaultdict(int)  # (field, user_id) -> amount
+        usage = collections.defaultdict(lambda: [0, 0, 0])  # (user_id, model, day) -> requests, prompt, completion
+        for item in batch:
+            if item[0] == "message":
+                _, user_id, content, is_from_user, token_count, epoch = item
+                messages.append({"owner_id": user_id, "content": content, "is_from_user": is_from_user,
+                                 "token_count": token_count, "epoch": epoch})
+            elif item[0] == "usage":
+                _, user_id, model, day, prompt_tokens, completion_tokens = item
+                totals = usage[(user_id, model, day)]
+                totals[0] += 1
+                totals[1] += prompt_tokens
+                totals[2] += completion_tokens
+            else:
+                _, user_id, field, amount = item
+                counters[(field, user_id)] += amount
+
+        counters_by_field = collections.defaultdict(list)
+        for (field, user_id), amount in counters.items():
+            counters_by_field[field].append({"user_id": user_id, "amount": amount})
+
+        async with models.db_session.session_scope() as session:
+            # Released in the commit itself: between the commit and the end of `session_scope` a context
+            # read would see the messages both in the DB and in `_pending_messages`
+            _after_commit(session, lambda: self._release(batch))
+            if messages:
+                await _execute(session, sa.insert(models.message.Message.__table__), messages)
+            for field, params in counters_by_field.items():
+                column = models.user.User.__table__.c[field]
+                statement = (
+                    sa.update(models.user.User.__table__)
+                    .where(models.user.User.__table__.c.id == sa.bindparam("user_id"))
+                    .values({field: column + sa.bindparam("amount")})
+                )
+                await _execute(session, statement, params)
+            if usage:
+                await _execute(session, _usage_upsert(), [
+                    {"user_id": user_id, "model": model, "day": day, "requests": requests,
+                     "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+                    for (user_id, model, day), (requests, prompt_tokens, completion_tokens) in usage.items()
+                ])
+
+        self.metrics["batches"] += 1
+        self.metrics["messages_written"] += len(messages)
+        self.metrics["counter_updates"] += len(counters)
+        self.metrics["usage_updates"] += len(usage)
+        self.metrics["last_batch_size"] = len(batch)
+        self.metrics["last_batch_ms"] = round((time.monotonic() - started_at) * 1000, 2)
+
+
+def _usage_upsert():
+    """INSERT of usage rows that adds to the counters of an existing (user, model, day) row"""
+    table = models.usage.Usage.__table__
+    statement = sqlalchemy.dialects.sqlite.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.model, table.c.day],
+        set_={column: table.c[column] + statement.excluded[column]
+              for column in ("requests", "prompt_tokens", "completion_tokens")},
+    )
+
+
+def _after_commit(session, callback):
+    """Calls `callback` once right after the session commits, for both sync and async session"""
+    sync_session = session.sync_session if models.db_session.is_async_session(session) else session
+    sa.event.listen(sync_session, "after_commit", lambda _: callback(), once=True)
+
+
+async def _execute(session, statement, params: list[dict]):
+    """Core executemany on the session's connection, for both sync and async session"""
+    if models.db_session.is_async_session(session):
+        connection = await session.connection()
+        await connection.execute(statement, params)
+    else:
+        session.connection().execute(statement, params)
+
+
+worker = PersistenceWorker()
@@ -0,0 +1,42 @@
+import asyncio
+import itertools
+
+
+class ActiveStream:
+    """Answer being streamed by a handler task, `stopped` is set when its user pressed Stop"""
+    __slots__ = ("id", "user_id", "task", "stopped")
+
+    def __init__(self, stream_id: int, user_id: int, task: asyncio.Task):
+        self.id = stream_id
+        self.user_id = user_id
+        self.task = task
+        self.stopped = False
+
+
+class StreamControl:
+    """Streams that can be stopped with the Stop button, by the id in its callback data"""
+
+    def __init__(self):
+        self._streams: dict[int, ActiveStream] = {}
+        self._ids = itertools.count(1)
+
+    def register(self, user_id: int) -> ActiveStream:
+        """Registers the current task, it is cancelled when the stream is stopped"""
+        stream = ActiveStream(next(self._ids), user_id, asyncio.current_task())
+        self._streams[stream.id] = stream
+        return stream
+
+    def unregister(self, stream: ActiveStream):
+        self._streams.pop(stream.id, None)
+
+    def stop(self, stream_id: int, user_id: int) -> bool:
+        """Cancels the stream's task, False if it has finished or belongs to another user"""
+        stream = self._streams.get(stream_id)
+        if stream is None or stream.user_id != user_id or stream.stopped:
+            return False
+        stream.stopped = True
+        stream.task.cancel()
+        return True
+
+
+control = StreamControl()
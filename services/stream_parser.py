@@ -0,0 +1,85 @@
+import json
+import typing
+
+# Frames of the proxy stream protocol, see llm_proxy/events.py
+PROTOCOL_VERSION = "1"
+PROTOCOL_HEADER = "X-Stream-Protocol"
+
+CONTENT = "content"
+REASONING = "reasoning"
+USAGE = "usage"
+ERROR = "error"
+DONE = "done"
+
+
+class Segment(typing.NamedTuple):
+    kind: str  # CONTENT or REASONING
+    text: str
+    is_block_end: bool = False  # True if the block ends right after `text`
+
+
+class StreamParser:
+    """Incremental parser for the NDJSON event stream of the proxy.
+
+    Raw bytes are split into lines, a frame split between chunks waits for the next `feed` call.
+    Consecutive deltas of one kind are merged into one segment. `usage`, `error` and `done`
+    frames are kept in attributes, check `error` after `close`.
+    """
+
+    def __init__(self):
+        self._pending = b""  # incomplete line from the previous chunk
+        self._started = False
+        self.in_reasoning = False
+        self.usage: dict | None = None
+        self.error: str | None = None
+        self.done = False
+
+    @property
+    def kind(self) -> str:
+        return REASONING if self.in_reasoning else CONTENT
+
+    def feed(self, chunk: bytes) -> list[Segment]:
+        """Feeds raw bytes from the stream and returns parsed segments"""
+        lines = (self._pending + chunk).split(b"\n")
+        self._pending = lines.pop()
+        return self._parse(lines)
+
+    def close(self) -> list[Segment]:
+        """Parses a last frame without a newline and marks a stream that ended without `done` as failed"""
+        lines = [self._pending] if self._pending.strip() else []
+        self._pending = b""
+        segments = self._parse(lines)
+        if not self.done and self.error is None:
+            self.error = "Stream ended unexpectedly"
+        return segments
+
+    def _parse(self, lines: list[bytes]) -> list[Segment]:
+        segments = []
+        texts = []  # deltas of the current kind
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                frame = json.loads(line)
+            except ValueError:
+                self.error = f"Invalid frame: {line[:100]!r}"
+                continue
+            frame_type = frame.get("type")
+            if frame_type in (CONTENT, REASONING):
+                in_reasoning = frame_type == REASONING
+                if self._started and in_reasoning != self.in_reasoning:
+                    segments.append(Segment(self.kind, "".join(texts), is_block_end=True))
+                    texts = []
+                self._started = True
+                self.in_reasoning = in_reasoning
+                texts.append(frame.get("text", ""))
+            elif frame_type == USAGE:
+                self.usage = {key: value for key, value in frame.items() if key != "type"}
+            elif frame_type == ERROR:
+                self.error = frame.get("message") or "Unknown error"
+            elif frame_type == DONE:
+                self.done = True
+            # Unknown frame types come from newer protocol versions and are skipped
+        if texts:
+            segments.append(Segment(self.kind, "".join(texts)))
+        return segments
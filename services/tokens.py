@@ -0,0 +1,15 @@
+import settings
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate without a tokenizer.
+
+    About 4 bytes of UTF-8 per token, which holds for English (~4 chars) and Cyrillic (~2 chars).
+    A few tokens are added for the message overhead in chat format.
+    """
+    return len(text.encode("utf-8")) // 4 + 4
+
+
+def get_context_budget(model: str) -> int:
+    """Returns max tokens of history to send with a request to `model`"""
+    return settings.CONTEXT_TOKEN_BUDGETS.get(model, settings.CONTEXT_TOKEN_BUDGETS["default"])
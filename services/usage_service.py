@@ -0,0 +1,62 @@
+import datetime
+import logging
+
+import sqlalchemy as sa
+
+import settings
+import models.db_session
+import models.usage
+import services.persistence_worker
+
+
+def today() -> datetime.date:
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+class UsageCounters:
+    """Tokens used today by every user, kept in memory for quota checks.
+
+    `load` reads today's totals once at startup, afterwards `record` updates memory at once and
+    queues the increments for the persistence worker, which writes them to `models.usage.Usage`
+    in batches. The counters start from zero when the day changes.
+    """
+
+    def __init__(self, daily_quota: int | None = settings.DAILY_TOKEN_QUOTA):
+        self.daily_quota = daily_quota
+        self.day = today()
+        self._tokens: dict[int, int] = {}  # user id -> tokens used today
+
+    def _roll_day(self):
+        current_day = today()
+        if current_day != self.day:
+            self.day = current_day
+            self._tokens.clear()
+
+    async def load(self):
+        self._roll_day()
+        table = models.usage.Usage.__table__
+        statement = (
+            sa.select(table.c.user_id, sa.func.sum(table.c.prompt_tokens + table.c.completion_tokens))
+            .where(table.c.day == self.day)
+            .group_by(table.c.user_id)
+        )
+        async with models.db_session.session_scope() as session:
+            rows = (await models.db_session.execute(session, statement)).all()
+        self._tokens = {user_id: int(tokens or 0) for user_id, tokens in rows}
+        logging.info(f"Loaded today's token usage of {len(self._tokens)} users")
+
+    def used_today(self, user_id: int) -> int:
+        self._roll_day()
+        return self._tokens.get(user_id, 0)
+
+    def is_over_quota(self, user_id: int) -> bool:
+        return self.daily_quota is not None and self.used_today(user_id) >= self.daily_quota
+
+    async def record(self, user_id: int, model: str, prompt_tokens: int, completion_tokens: int):
+        self._roll_day()
+        self._tokens[user_id] = self._tokens.get(user_id, 0) + prompt_tokens + completion_tokens
+        await services.persistence_worker.worker.add_usage(user_id, model, self.day, prompt_tokens,
+                                                           completion_tokens)
+
+
+counters = UsageCounters()
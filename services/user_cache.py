@@ -0,0 +1,111 @@
+import collections
+import time
+import typing
+
+import sqlalchemy.event
+import sqlalchemy.orm
+import sqlalchemy.ext.asyncio
+
+import settings
+import models.user
+
+
+class UserSettings(typing.NamedTuple):
+    """Read-only snapshot of the user fields that are needed to handle most updates"""
+    id: int
+    username: str
+    referrer_id: int | None
+    is_banned: bool
+    context_mode_on: bool
+    instruction_mode_on: bool
+    selected_model: str | None
+    instruction: str | None
+    context_epoch: int
+
+    @classmethod
+    def from_user(cls, user: models.user.User) -> "UserSettings":
+        return cls(
+            id=user.id,
+            username=user.username,
+            referrer_id=user.referrer_id,
+            is_banned=bool(user.is_banned),
+            context_mode_on=bool(user.context_mode_on),
+            instruction_mode_on=bool(user.instruction_mode_on),
+            selected_model=user.selected_model,
+            instruction=user.instruction,
+            context_epoch=user.context_epoch or 0,
+        )
+
+
+class UserCache:
+    """Process-wide LRU cache of `UserSettings` with a TTL.
+
+    Every code that changes cached fields must call `invalidate_after_commit` for the user.
+    """
+
+    def __init__(self,
+                 max_users: int = settings.USER_CACHE_MAX_USERS,
+                 ttl: float = settings.USER_CACHE_TTL_SEC):
+        self.max_users = max_users
+        self.ttl = ttl
+
+        self._entries: collections.OrderedDict[int, tuple[UserSettings, float]] = collections.OrderedDict()
+        self._loading: dict[int, bool] = {}  # user id -> invalidated while loading from DB
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> UserSettings | None:
+        entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self._entries.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0]
+
+    def begin_load(self, user_id: int):
+        """Marks start of a DB read, `put` is skipped if the user is invalidated before it finishes"""
+        self._loading[user_id] = False
+
+    def cancel_load(self, user_id: int):
+        self._loading.pop(user_id, None)
+
+    def put(self, user_settings: UserSettings):
+        if self._loading.pop(user_settings.id, False):
+            return
+        self._entries[user_settings.id] = (user_settings, time.monotonic())
+        self._entries.move_to_end(user_settings.id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        if user_id in self._loading:
+            self._loading[user_id] = True
+        self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = UserCache()
+
+
+def invalidate_after_commit(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession, user_id: int):
+    """Invalidates the user now and once more when `session` commits.
+
+    A concurrent read between the change and the commit would otherwise cache the old row again.
+    """
+    cache.invalidate(user_id)
+    session.info.setdefault("invalidate_user_ids", set()).add(user_id)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_commit")
+def _invalidate_committed(session: sqlalchemy.orm.Session):
+    for user_id in session.info.pop("invalidate_user_ids", ()):
+        cache.invalidate(user_id)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.Session, "after_rollback")
+def _forget_rolled_back(session: sqlalchemy.orm.Session):
+    session.info.pop("invalidate_user_ids", None)
@@ -2,11 +2,14 @@ import logging
 import typing
 
 import aiogram
+import sqlalchemy as sa
 import sqlalchemy.orm
 import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
 
 import models.db_session
 import models.user
+import services.user_cache
 
 
 async def get_or_create_user(session: sqlalchemy.orm.Session, telegram_user: aiogram.types.User) -> models.user.User:
@@ -50,7 +53,75 @@ def get_user_instruction(session: sqlalchemy.orm.Session):
     user: models.user.User = session.get(models.user.User)
 
 
-async def set_instruction(instruction: str, session: sqlalchemy.orm.Session, user: models.user.User):
-    user.instruction = instruction
+async def get_or_create_user_async(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                                   telegram_user: aiogram.types.User) -> models.user.User:
+    """async version of `get_or_create_user`, falls back to it for sync session"""
+    if not models.db_session.is_async_session(session):
+        return await get_or_create_user(session, telegram_user)
+
+    user: typing.Optional[models.user.User] = await session.get(models.user.User, telegram_user.id)
+
+    if user:
+        if telegram_user.username and telegram_user.username != user.username:
+            user.username = telegram_user.username
+            try:
+                session.add(user)
+                await session.flush()
+            except sqlalchemy.exc.SQLAlchemyError as error:
+                print(f"Failed to flush updates for user {user.id}: {error}")
+                raise
+        return user
+
+    print(f"User {telegram_user.id} not found. Creating...")
+    username_to_save = telegram_user.username or f"user_{telegram_user.id}"
+    new_user = models.user.User(id=telegram_user.id, username=username_to_save)
+    try:
+        session.add(new_user)
+        await session.flush()
+        return new_user
+    except sqlalchemy.exc.SQLAlchemyError as error:
+        print(f"Failed to flush new user {telegram_user.id}: {error}")
+        raise
+
+
+async def save_user(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession, user: models.user.User):
+    """Adds user to the session and flushes changes, works with both sync and async session"""
     session.add(user)
-    session.flush()
\ No newline at end of file
+    if models.db_session.is_async_session(session):
+        await session.flush()
+    else:
+        session.flush()
+
+
+async def count_referrals(session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                          user: models.user.User) -> int:
+    """Returns number of users invited by `user` without loading them"""
+    query = sa.select(sa.func.count()).select_from(models.user.User).where(models.user.User.referrer_id == user.id)
+    if models.db_session.is_async_session(session):
+        return (await session.execute(query)).scalar_one()
+    return session.execute(query).scalar_one()
+
+
+async def get_user_settings(telegram_user: aiogram.types.User) -> services.user_cache.UserSettings:
+    """Cached settings of the user, the DB is queried (and the user created) only on a cache miss"""
+    user_settings = services.user_cache.cache.get(telegram_user.id)
+    if user_settings is not None:
+        return user_settings
+
+    services.user_cache.cache.begin_load(telegram_user.id)
+    try:
+        async with models.db_session.session_scope() as session:
+            user = await get_or_create_user_async(session, telegram_user)
+            user_settings = services.user_cache.UserSettings.from_user(user)
+    except Exception:
+        services.user_cache.cache.cancel_load(telegram_user.id)
+        raise
+    services.user_cache.cache.put(user_settings)
+    return user_settings
+
+
+async def set_instruction(instruction: str, session: sqlalchemy.orm.Session | sqlalchemy.ext.asyncio.AsyncSession,
+                          user: models.user.User):
+    user.instruction = instruction
+    await save_user(session, user)
+    services.user_cache.invalidate_after_commit(session, user.id)
\ No newline at end of file
@@ -1,2 +1,66 @@
 DEBUG_MODE = True
-DB_FILE = "db.sqlite3"
\ No newline at end of file
+DB_FILE = "db.sqlite3"
+DB_ASYNC = True  # AsyncSession over aiosqlite, False falls back to the sync engine
+
+# Telegram edit scheduler
+EDIT_GLOBAL_RATE = 30  # Bot-wide messages per second
+EDIT_PRIVATE_CHAT_RATE = 1  # Messages per second in a private chat
+EDIT_GROUP_CHAT_RATE = 20 / 60  # Messages per second in a group
+EDIT_MIN_INTERVAL_SEC = 1.1  # Min interval between edits of one message
+EDIT_MAX_INTERVAL_SEC = 4.0
+EDIT_INTERVAL_PER_CHAR_SEC = 0.0004  # Long messages are edited less often, +1.6s at 4000 chars
+EDIT_MIN_NEW_CHARS = 40  # Desired amount of new text per edit for slow streams
+EDIT_STATS_TTL_SEC = 600
+
+# HTTP client for the LLM proxy
+AI_HTTP_POOL_SIZE = 100  # Max open connections
+AI_HTTP_POOL_SIZE_PER_HOST = 100
+AI_HTTP_KEEPALIVE_SEC = 60
+AI_HTTP_DNS_CACHE_SEC = 300
+AI_HTTP_CONNECT_TIMEOUT_SEC = 10
+AI_HTTP_READ_TIMEOUT_SEC = 120  # Max gap between stream chunks
+
+# Write-behind persistence of history and counters
+PERSIST_QUEUE_SIZE = 10000
+PERSIST_BATCH_SIZE = 500
+PERSIST_FLUSH_INTERVAL_SEC = 0.2
+PERSIST_MAX_RETRIES = 3
+
+# Context window
+CONTEXT_MAX_MESSAGES = 100  # Max messages read from DB for one request
+CONTEXT_TOKEN_BUDGETS = {  # Tokens of history per model
+    "default": 8000,
+    "qwen3-235b-a22b": 16000,
+    "llama-4-maverick": 16000,
+    "deepseek-r1": 12000,
+    "deepseek-v3": 12000,
+}
+
+# Per-user cache of recent context
+CONTEXT_CACHE_MAX_USERS = 5000
+CONTEXT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+CONTEXT_CACHE_TTL_SEC = 30 * 60
+
+# Rolling summaries of long histories
+COMPACTION_ENABLED = True
+COMPACTION_THRESHOLD_RATIO = 0.75  # Compact when history is above this part of the model's context budget
+COMPACTION_KEEP_RATIO = 0.25  # Part of the budget that stays as original messages after compaction
+COMPACTION_MODEL = None  # Model for summaries, None means the user's model
+
+# Deleting messages of cleared contexts
+PURGE_CLEARED_MESSAGES = True  # False keeps old rows in the table as an archive
+PURGE_INTERVAL_SEC = 10 * 60
+PURGE_BATCH_SIZE = 1000
+
+# Cache of user settings snapshots, handlers that don't ask for a DB session read settings from it
+USER_CACHE_MAX_USERS = 10000
+USER_CACHE_TTL_SEC = 5 * 60
+
+# Requests without context may be answered from the proxy's response cache
+AI_CACHE_ONE_SHOT_REQUESTS = True
+
+# Tokens per user per day (UTC) counted from the proxy's usage frames, None means no limit
+DAILY_TOKEN_QUOTA = None
+
+# Model list from the proxy's /v1/models, strings.MODELS is used until it loads
+MODEL_CATALOG_TTL_SEC = 5 * 60
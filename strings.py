@@ -7,14 +7,14 @@ GREETING = '''
 Hi, I'm AI bot
 '''
 
-def profile_info(user: User):
+def profile_info(user: User, referrals_count: int):
     return f"""
 *👤 {user.username}*
 
 Register date: {str(user.registered_at).split()[0]}
 Sent requests: {user.requests}
 Successful requests: {user.successful_requests}
-Referrals: {len(user.referrals)}
+Referrals: {referrals_count}
 """
 
 
@@ -63,6 +63,15 @@ MODELS = {
 
 MODEL_SELECTED = "🟢 "
 
+DAILY_QUOTA_REACHED = "You have used your daily token limit. Please try again tomorrow."
+
+
+class STOP_STREAM:
+    BUTTON = "⏹ Stop"
+    STOPPING = "Stopping..."
+    FINISHED = "The answer is already finished"
+    STOPPED = "⏹ Stopped"
+
 
 class SETTINGS_MENUS:
     BACK = "< Back"
@@ -124,4 +133,9 @@ In this section, you can:
 
 class CLEAR_CONTEXT:
     SUCESS = "✅ Context successfully cleared. AI wouldn't see messages above."
-    ERROR = "❌ Context clearing has failed. Try again."
\ No newline at end of file
+    ERROR = "❌ Context clearing has failed. Try again."
+
+CONTEXT_SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+COMPACTION_INSTRUCTIONS = """Summarize the conversation below for your own future reference.
+Keep facts about the user, decisions, open questions and anything needed to continue the dialogue.
+Write in the language of the conversation, no longer than necessary. Reply with the summary only."""